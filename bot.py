@@ -1,11 +1,18 @@
 import logging
 import random
+import re
+import time
 import pytz
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta
 import asyncio
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
+from telegram.error import Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     CallbackQueryHandler,
@@ -14,15 +21,9 @@ from telegram.ext import (
     filters
 )
 import config
-from database import Database
+from database import Database, _today_minsk, _parse_date
 from functools import wraps
 
-MINSK_TZ = pytz.timezone('Europe/Minsk')
-
-def _today_minsk():
-    """Текущая дата по минскому времени (UTC+3)."""
-    return datetime.now(MINSK_TZ).date()
-
 
 def escape_markdown(text):
     """Экранирует специальные символы Markdown"""
@@ -42,8 +43,9 @@ def ensure_user(func):
         user = update.effective_user
 
         # Проверяем существует ли пользователь
-        if not db.get_user(user.id):
-            db.add_user(
+        if not await asyncio.to_thread(db.get_user, user.id):
+            await asyncio.to_thread(
+                db.add_user,
                 user_id=user.id,
                 username=user.username or user.first_name,
                 first_name=user.first_name,
@@ -66,53 +68,119 @@ logger = logging.getLogger(__name__)
 db = Database()
 
 
-async def check_and_reset_streaks(bot):
+async def send_message_safe(bot, chat_id: int, text: str, **kwargs) -> bool:
+    """
+    Отправляет сообщение, не роняя обработчик.
+    При RetryAfter (429) ждёт сколько просит Telegram и пробует ещё раз.
+    Возвращает True при успехе.
+    """
+    for attempt in range(2):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            return True
+        except RetryAfter as e:
+            if attempt:
+                logger.warning(f"Не удалось отправить сообщение {chat_id}: {e}")
+                return False
+            await asyncio.sleep(e.retry_after)
+        except Forbidden:
+            return False  # пользователь заблокировал бота
+        except TelegramError as e:
+            # Сюда же BadRequest: кроме недоступного чата это и ошибки в нашем тексте
+            # (например "can't parse entities") — их нельзя глотать молча
+            logger.warning(f"Не удалось отправить сообщение {chat_id}: {e}")
+            return False
+    return False
+
+
+# ============= СТАТИЧНЫЕ КЛАВИАТУРЫ =============
+# Разметка неизменяема после создания, поэтому одни и те же объекты
+# безопасно переиспользуются во всех обработчиках.
+
+_MAIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎯 Получить челлендж", callback_data='back_to_categories')],
+    [InlineKeyboardButton("👤 Профиль", callback_data='profile')],
+    [InlineKeyboardButton("🛒 Магазин", callback_data='shop')],
+])
+_ADMIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Статистика бота", callback_data='admin_stats')],
+    [InlineKeyboardButton("👥 Список пользователей", callback_data='admin_users')],
+    [InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast_menu')],
+    [InlineKeyboardButton("🗑️ Удалить пользователя", callback_data='admin_delete_menu')],
+    [InlineKeyboardButton("💰 Выдать монеты", callback_data='admin_give_coins')],
+    [InlineKeyboardButton("⚠️ Жалобы пользователей", callback_data='admin_reports')],
+])
+_BACK_TO_MAIN_KB = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]])
+_BACK_TO_PROFILE_KB = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад в профиль", callback_data='profile')]])
+_BACK_TO_SHOP_KB = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]])
+_TO_SHOP_KB = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ В магазин", callback_data='shop')]])
+_BACK_TO_ADMIN_KB = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='admin_back')]])
+_BACK_TO_BROADCAST_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("◀️ Назад", callback_data='admin_broadcast_menu')]]
+)
+
+
+def _reset_missed_streaks() -> list:
+    """Сбросить стрики пропустившим вчерашний день; вернуть их user_id (синхронно, для потока)"""
     today_dt = _today_minsk()
     today = today_dt.isoformat()
     yesterday = (today_dt - timedelta(days=1)).isoformat()
-    users = db.get_all_users()
-
-    for user_id in users:
-        user = db.get_user(user_id)
+    # Сначала собираем, кому сбросить стрик, потом пишем в БД одной транзакцией
+    to_reset = []
+    for user in db.iter_all_users_full(
+        ('streak', 'last_completed_date', 'streak_freeze_until')
+    ):
+        user_id = user['user_id']
         last = user.get('last_completed_date')
 
         if last != today and last != yesterday:
             freeze_until = user.get('streak_freeze_until')
-            if freeze_until and date.fromisoformat(freeze_until) >= today_dt:
+            if freeze_until and _parse_date(freeze_until) >= today_dt:
                 continue
             if user.get('streak', 0) > 0:
-                db.reset_streak(user_id)
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text="💔 Твой стрик сброшен — вчера не было выполнено задание.\n\n"
-                             "Но это не конец! Начни заново сегодня 💪"
-                    )
-                except Exception:
-                    pass
+                to_reset.append(user_id)
 
+    db.reset_streaks_bulk(to_reset)
+    return to_reset
 
-async def send_evening_reminder(bot):
-    today = _today_minsk().isoformat()
-    users = db.get_all_users()
 
-    for user_id in users:
-        user = db.get_user(user_id)
+async def check_and_reset_streaks(bot):
+    # Проход по всем пользователям — в отдельном потоке, event loop не блокируется
+    to_reset = await asyncio.to_thread(_reset_missed_streaks)
+
+    for user_id in to_reset:
+        await send_message_safe(
+            bot, user_id,
+            "💔 Твой стрик сброшен — вчера не было выполнено задание.\n\n"
+            "Но это не конец! Начни заново сегодня 💪"
+        )
+
+
+def _users_to_remind() -> list:
+    """user_id тех, кто сегодня ещё не выполнил челлендж и не под заморозкой"""
+    today_dt = _today_minsk()
+    today = today_dt.isoformat()
+    to_remind = []
+    for user in db.iter_all_users_full(('last_completed_date', 'streak_freeze_until')):
+        user_id = user['user_id']
         if user.get('last_completed_date') == today:
             continue  # уже выполнил — не беспокоим
 
         freeze_until = user.get('streak_freeze_until')
-        if freeze_until and date.fromisoformat(freeze_until) >= _today_minsk():
+        if freeze_until and _parse_date(freeze_until) >= today_dt:
             continue  # заморозка активна — не беспокоим
 
-        try:
-            await bot.send_message(
-                chat_id=user_id,
-                text="⏰ Эй, ты ещё не выполнил челлендж сегодня!\n\n"
-                     "Осталось несколько часов — успей сохранить стрик 🔥"
-            )
-        except Exception:
-            pass
+        to_remind.append(user_id)
+    return to_remind
+
+
+async def send_evening_reminder(bot):
+    for user_id in await asyncio.to_thread(_users_to_remind):
+        await send_message_safe(
+            bot, user_id,
+            "⏰ Эй, ты ещё не выполнил челлендж сегодня!\n\n"
+            "Осталось несколько часов — успей сохранить стрик 🔥"
+        )
 
 
 def get_user_level(total_completed: int) -> str:
@@ -183,11 +251,8 @@ def check_achievements(user_id: int, user_data: dict) -> list[dict]:
     streak = user_data['streak']
     total = user_data['total_completed']
 
-    # Подсчет по категориям
-    category_counts = {}
-    for entry in user_data['history']:
-        cat = entry.get('category', 'unknown')
-        category_counts[cat] = category_counts.get(cat, 0) + 1
+    # Подсчет по категориям (уже посчитан в БД)
+    category_counts = user_data['category_stats']
 
     for achievement_id, achievement in config.ACHIEVEMENTS.items():
         # Пропускаем уже полученные
@@ -210,8 +275,8 @@ def check_achievements(user_id: int, user_data: dict) -> list[dict]:
 
         if earned:
             # Добавляем достижение
-            if db.add_achievement(user_id, achievement_id):
-                db.add_coins(user_id, achievement['reward'])
+            # Достижение и монеты за него — одной транзакцией
+            if db.grant_reward(user_id, coins=achievement['reward'], achievement_id=achievement_id):
                 new_achievements.append({
                     'id': achievement_id,
                     'name': achievement['name'],
@@ -238,14 +303,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Увеличивай streak 🔥
 • Открывай достижения 🏆"""
 
-    keyboard = [
-        [InlineKeyboardButton("🎯 Получить челлендж", callback_data='back_to_categories')],
-        [InlineKeyboardButton("👤 Профиль", callback_data='profile')],
-        [InlineKeyboardButton("🛒 Магазин", callback_data='shop')],
-    ]
     await update.message.reply_text(
         welcome_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_MAIN_MENU_KB,
         parse_mode='Markdown'
     )
 
@@ -255,23 +315,22 @@ async def profile_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    stats = db.get_stats(user_id)
+    stats = await asyncio.to_thread(db.get_stats, user_id)
 
     if not stats:
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]
         await query.edit_message_text(
             "У тебя пока нет данных. Начни выполнять челленджи!",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=_BACK_TO_MAIN_KB
         )
         return
 
-    import json
-    user = db.get_user(user_id)
-    user_achievements = json.loads(user['achievements']) if user['achievements'] else []
+    user = await asyncio.to_thread(db.get_user, user_id)
+    user_achievements = user['achievements']
     level = get_user_level(stats['total_completed'])
     progress_bar = get_progress_bar(stats['total_completed'])
     coins = stats.get('coins', 0)
-    today = _today_minsk().isoformat()
+    today_dt = _today_minsk()
+    today = today_dt.isoformat()
 
     streak = stats['streak']
     longest_streak = user.get('longest_streak', 0)
@@ -281,7 +340,7 @@ async def profile_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         streak_status = f"🔥 Streak: *{streak} дней* ✅"
     else:
         freeze_until = user.get('streak_freeze_until')
-        if freeze_until and date.fromisoformat(freeze_until) >= _today_minsk():
+        if freeze_until and _parse_date(freeze_until) >= today_dt:
             streak_status = f"🔥 Streak: *{streak} дней* 🛡️"
         else:
             streak_status = f"🔥 Streak: *{streak} дней* ⚠️"
@@ -360,23 +419,24 @@ async def category_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     category = query.data.replace('cat_', '')
 
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     if not user:
         username = query.from_user.username or query.from_user.first_name
-        db.add_user(
+        await asyncio.to_thread(
+            db.add_user,
             user_id=user_id,
             username=username,
             first_name=query.from_user.first_name,
             language_code=query.from_user.language_code or 'ru'
         )
-        user = db.get_user(user_id)
+        user = await asyncio.to_thread(db.get_user, user_id)
 
     today = _today_minsk().isoformat()
     can_complete = user['last_completed_date'] != today
 
     if user.get('challenge_date') != today:
-        db.update_challenge(user_id, None, None)
-        user = db.get_user(user_id)
+        await asyncio.to_thread(db.update_challenge, user_id, None, None)
+        user = await asyncio.to_thread(db.get_user, user_id)
 
     emoji = config.CATEGORIES[category]['emoji']
     cat_name = config.CATEGORIES[category]['name']
@@ -420,7 +480,7 @@ async def category_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         recent.pop(0)
     context.user_data[history_key] = recent
 
-    db.update_challenge(user_id, challenge, category)
+    await asyncio.to_thread(db.update_challenge, user_id, challenge, category)
 
     message_text = f"""{emoji} *Категория: {cat_name}*
 
@@ -443,7 +503,7 @@ async def another_challenge_handler(update: Update, context: ContextTypes.DEFAUL
     await query.answer()
 
     user_id = query.from_user.id
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
 
     if not user or not user['current_category']:
         text = "Сначала выбери категорию челленджа:"
@@ -477,7 +537,7 @@ async def another_challenge_handler(update: Update, context: ContextTypes.DEFAUL
         recent.pop(0)
     context.user_data[history_key] = recent
 
-    db.update_challenge(user_id, challenge, category)
+    await asyncio.to_thread(db.update_challenge, user_id, challenge, category)
 
     emoji = config.CATEGORIES[category]['emoji']
     cat_name = config.CATEGORIES[category]['name']
@@ -530,18 +590,16 @@ async def complete_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
 
     try:
-        result = db.complete_challenge(user_id)
+        result = await asyncio.to_thread(db.complete_challenge, user_id)
     except Exception as e:
         logger.error(f"Ошибка при выполнении челленджа: {e}")
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]
         await query.edit_message_text("❌ Произошла ошибка. Попробуйте еще раз.",
-                                      reply_markup=InlineKeyboardMarkup(keyboard))
+                                      reply_markup=_BACK_TO_MAIN_KB)
         return
 
     if not result.get('success', False):
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]
         await query.edit_message_text(result.get('message', 'Ошибка'),
-                                      reply_markup=InlineKeyboardMarkup(keyboard))
+                                      reply_markup=_BACK_TO_MAIN_KB)
         return
 
     streak = int(result.get('streak', 1))
@@ -550,8 +608,8 @@ async def complete_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     total_coins = int(result.get('total_coins', 5))
 
     try:
-        user_data = db.get_stats(user_id)
-        new_achievements = check_achievements(user_id, user_data)
+        user_data = await asyncio.to_thread(db.get_stats, user_id)
+        new_achievements = await asyncio.to_thread(check_achievements, user_id, user_data)
     except Exception as e:
         logger.error(f"Ошибка при проверке достижений: {e}")
         new_achievements = []
@@ -610,16 +668,15 @@ async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         user_id = update.effective_user.id
 
-    stats = db.get_stats(user_id)
+    stats = await asyncio.to_thread(db.get_stats, user_id)
 
     if not stats:
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]
         if query:
             await query.edit_message_text("Нет данных. Начни выполнять челленджи!",
-                                          reply_markup=InlineKeyboardMarkup(keyboard))
+                                          reply_markup=_BACK_TO_MAIN_KB)
         else:
             await update.message.reply_text("Нет данных. Начни выполнять челленджи!",
-                                            reply_markup=InlineKeyboardMarkup(keyboard))
+                                            reply_markup=_BACK_TO_MAIN_KB)
         return
 
     level = get_user_level(stats['total_completed'])
@@ -656,15 +713,11 @@ async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 {category_text}
 {"Последний: *" + last_date_formatted + "*" if last_date_formatted else ""}"""
 
-    keyboard = [
-        [InlineKeyboardButton("◀️ Назад в профиль", callback_data='profile')],
-    ]
-
     if query:
-        await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard),
+        await query.edit_message_text(message_text, reply_markup=_BACK_TO_PROFILE_KB,
                                       parse_mode='Markdown')
     else:
-        await update.message.reply_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard),
+        await update.message.reply_text(message_text, reply_markup=_BACK_TO_PROFILE_KB,
                                         parse_mode='Markdown')
 
 
@@ -681,12 +734,11 @@ async def achievements_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     else:
         user_id = update.effective_user.id
 
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     if not user:
         return
 
-    import json
-    user_achievements = json.loads(user['achievements']) if user['achievements'] else []
+    user_achievements = user['achievements']
     coins = user['coins']
 
     lines = [f"🏆 *Достижения* ({len(user_achievements)}/{len(config.ACHIEVEMENTS)})\n"]
@@ -700,15 +752,11 @@ async def achievements_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     lines.append(f"\n💰 Монет: *{coins}*")
     text = "\n\n".join(lines)
 
-    keyboard = [
-        [InlineKeyboardButton("◀️ Назад в профиль", callback_data='profile')],
-    ]
-
     if query:
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard),
+        await query.edit_message_text(text, reply_markup=_BACK_TO_PROFILE_KB,
                                       parse_mode='Markdown')
     else:
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard),
+        await update.message.reply_text(text, reply_markup=_BACK_TO_PROFILE_KB,
                                         parse_mode='Markdown')
 
 
@@ -734,9 +782,13 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ============= АДМИН ПАНЕЛЬ =============
 
+# Набор ID админов собирается один раз; is_admin и фильтр сообщений смотрят сюда
+_ADMIN_IDS: frozenset[int] = frozenset({config.ADMIN_ID})
+
+
 def is_admin(user_id: int) -> bool:
     """Проверка является ли пользователь админом"""
-    return user_id == config.ADMIN_ID
+    return user_id in _ADMIN_IDS
 
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -747,18 +799,9 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет доступа к админ-панели.")
         return
 
-    keyboard = [
-        [InlineKeyboardButton("📊 Статистика бота", callback_data='admin_stats')],
-        [InlineKeyboardButton("👥 Список пользователей", callback_data='admin_users')],
-        [InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast_menu')],
-        [InlineKeyboardButton("🗑️ Удалить пользователя", callback_data='admin_delete_menu')],
-        [InlineKeyboardButton("💰 Выдать монеты", callback_data='admin_give_coins')],
-        [InlineKeyboardButton("⚠️ Жалобы пользователей", callback_data='admin_reports')],
-    ]
-
     await update.message.reply_text(
         "🔐 *Админ-панель*\n\nВыберите действие:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_ADMIN_MENU_KB,
         parse_mode='Markdown'
     )
 
@@ -772,50 +815,23 @@ async def admin_stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.edit_message_text("❌ Доступ запрещен.")
         return
 
-    users = db.get_all_users()
-    total_users = len(users)
-    today = _today_minsk().isoformat()
-
-    conn = db.get_connection()
-    cursor = conn.cursor()
-
-    # ПРАВИЛЬНЫЕ НАЗВАНИЯ С ПОДЧЕРКИВАНИЕМ!
-    cursor.execute('SELECT SUM(total_completed) FROM users', ())
-    total_challenges = cursor.fetchone()[0] or 0
-
-    cursor.execute('SELECT COUNT(*) FROM users WHERE last_completed_date = %s', (today,))
-    total_active_today = cursor.fetchone()[0] or 0
-
-    cursor.execute('SELECT AVG(streak) FROM users')
-    avg_streak = cursor.fetchone()[0] or 0
-
-    cursor.execute("SELECT COUNT(*) FROM reports WHERE status = 'pending'")
-    pending_reports = cursor.fetchone()[0] or 0
-
-    cursor.execute('SELECT COUNT(*) FROM reports WHERE DATE(created_at) = %s', (today,))
-    reports_today = cursor.fetchone()[0] or 0
-
-    cursor.execute('SELECT COUNT(*) FROM users WHERE warnings >= 3')
-    banned_users = cursor.fetchone()[0] or 0
-
-    conn.close()
+    stats = await asyncio.to_thread(db.get_admin_stats)
 
     message = f"""📊 *Статистика бота 'Малый Шаг'*
 
-👥 Всего пользователей: *{total_users}*
-✅ Активных сегодня: *{total_active_today}*
-🎯 Всего челленджей: *{total_challenges}*
-🔥 Средний streak: *{avg_streak:.1f}* дней
-⚠️ Новых жалоб: *{pending_reports}*
-📋 Жалоб за сегодня: *{reports_today}*
-🚫 Забаненных: *{banned_users}*
+👥 Всего пользователей: *{stats['total_users']}*
+✅ Активных сегодня: *{stats['active_today']}*
+🎯 Всего челленджей: *{stats['total_challenges']}*
+🔥 Средний streak: *{stats['avg_streak']:.1f}* дней
+⚠️ Новых жалоб: *{stats['pending_reports']}*
+📋 Жалоб за сегодня: *{stats['reports_today']}*
+🚫 Забаненных: *{stats['banned_users']}*
 
 📈 Показатели растут! 🚀"""
 
-    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data='admin_back')]]
     await query.edit_message_text(
         message,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_BACK_TO_ADMIN_KB,
         parse_mode='Markdown'
     )
 
@@ -828,18 +844,7 @@ async def admin_users_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not is_admin(query.from_user.id):
         return
 
-    conn = db.get_connection()
-    cursor = conn.cursor()
-
-    # ПРАВИЛЬНЫЕ НАЗВАНИЯ С ПОДЧЕРКИВАНИЕМ!
-    cursor.execute('''
-        SELECT user_id, username, total_completed, streak, coins, warnings
-        FROM users
-        ORDER BY total_completed DESC
-        LIMIT 15
-    ''')
-    users = cursor.fetchall()
-    conn.close()
+    users = await asyncio.to_thread(db.get_top_users, 15)
 
     if not users:
         message = "📋 Пользователей пока нет."
@@ -853,10 +858,9 @@ async def admin_users_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             message += f" ID: `{user_id}`\n"
             message += f" ✅ {total} | 🔥 {streak} | 💰 {coins}\n\n"
 
-    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data='admin_back')]]
     await query.edit_message_text(
         message,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=_BACK_TO_ADMIN_KB
     )
 
 
@@ -865,15 +869,21 @@ async def send_any_message(bot, chat_id: int, source_msg) -> bool:
     Копирует сообщение любого типа через copy_message.
     Не показывает пометку Переслано. Возвращает True при успехе.
     """
-    try:
-        await bot.copy_message(
-            chat_id=chat_id,
-            from_chat_id=source_msg.chat_id,
-            message_id=source_msg.message_id,
-        )
-        return True
-    except Exception:
-        return False
+    for attempt in range(2):
+        try:
+            await bot.copy_message(
+                chat_id=chat_id,
+                from_chat_id=source_msg.chat_id,
+                message_id=source_msg.message_id,
+            )
+            return True
+        except RetryAfter as e:
+            if attempt:
+                return False
+            await asyncio.sleep(e.retry_after)
+        except TelegramError:
+            return False
+    return False
 
 
 # ============= РАССЫЛКА =============
@@ -908,14 +918,12 @@ async def admin_broadcast_all_handler(update: Update, context: ContextTypes.DEFA
     if not is_admin(query.from_user.id):
         return
 
-    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data='admin_broadcast_menu')]]
-
     await query.edit_message_text(
         "📢 *Рассылка всем пользователями*\n\n"
         "Отправьте сообщение любого типа:\n"
         "\\(текст, фото, видео, голосовое, документ, стикер и т\\.д\\.\\)\\n",
 
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_BACK_TO_BROADCAST_KB,
         parse_mode='Markdown'
     )
 
@@ -973,13 +981,11 @@ async def admin_delete_menu_handler(update: Update, context: ContextTypes.DEFAUL
     if not is_admin(query.from_user.id):
         return
 
-    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data='admin_back')]]
-
     await query.edit_message_text(
         "🗑️ *Удаление пользователя*\n\n"
         "Отправьте ID пользователя для удаления:\n"
         "`123456789`",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_BACK_TO_ADMIN_KB,
         parse_mode='Markdown'
     )
 
@@ -996,13 +1002,11 @@ async def admin_give_coins_handler(update: Update, context: ContextTypes.DEFAULT
     if not is_admin(query.from_user.id):
         return
 
-    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data='admin_back')]]
-
     await query.edit_message_text(
         "💰 *Выдать монеты*\n\n"
         "Формат: `USER_ID КОЛИЧЕСТВО`\n\n"
         "Например: `123456789 100`",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_BACK_TO_ADMIN_KB,
         parse_mode='Markdown'
     )
 
@@ -1018,7 +1022,7 @@ async def admin_reports_handler(update: Update, context: ContextTypes.DEFAULT_TY
     if not is_admin(query.from_user.id):
         return
 
-    reports = db.getpendingreports()
+    reports = await asyncio.to_thread(db.getpendingreports)
 
     if not reports:
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='admin_back')]]
@@ -1054,16 +1058,7 @@ async def admin_report_detail_handler(update: Update, context: ContextTypes.DEFA
         return
 
     report_id = int(query.data.replace('admin_report_', ''))
-
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT user_id, username, message, created_at
-        FROM reports WHERE id = %s
-    ''', (report_id,))
-
-    report = cursor.fetchone()
-    conn.close()
+    report = await asyncio.to_thread(db.get_report, report_id)
 
     if not report:
         await query.edit_message_text("❌ Жалоба не найдена.")
@@ -1136,16 +1131,13 @@ async def admin_approve_report_handler(update: Update, context: ContextTypes.DEF
     report_id = int(parts[2])
     user_id = int(parts[3])
 
-    db.update_report_status(report_id, 'approved', 'Жалоба рассмотрена положительно')
+    await asyncio.to_thread(db.update_report_status, report_id, 'approved', 'Жалоба рассмотрена положительно')
 
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="✅ *Ответ от Администрации*\n\nВаша жалоба рассмотрена и принята к сведению. Спасибо за обратную связь!",
-            parse_mode='Markdown'
-        )
-    except:
-        pass
+    await send_message_safe(
+        context.bot, user_id,
+        "✅ *Ответ от Администрации*\n\nВаша жалоба рассмотрена и принята к сведению. Спасибо за обратную связь!",
+        parse_mode='Markdown'
+    )
 
     await admin_reports_handler(update, context)
 
@@ -1162,16 +1154,13 @@ async def admin_reject_report_handler(update: Update, context: ContextTypes.DEFA
     report_id = int(parts[2])
     user_id = int(parts[3])
 
-    db.update_report_status(report_id, 'rejected', 'Жалоба отклонена')
+    await asyncio.to_thread(db.update_report_status, report_id, 'rejected', 'Жалоба отклонена')
 
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="❌ *Ответ от Администрации*\n\nВаша жалоба была рассмотрена и отклонена.",
-            parse_mode='Markdown'
-        )
-    except:
-        pass
+    await send_message_safe(
+        context.bot, user_id,
+        "❌ *Ответ от Администрации*\n\nВаша жалоба была рассмотрена и отклонена.",
+        parse_mode='Markdown'
+    )
 
     await admin_reports_handler(update, context)
 
@@ -1202,233 +1191,287 @@ async def admin_warn_report_handler(update: Update, context: ContextTypes.DEFAUL
     }
 
 
-# ============= ОБРАБОТЧИК СООБЩЕНИЙ ДЛЯ АДМИНА =============
+# ============= ДАЙДЖЕСТ ЖАЛОБ ДЛЯ АДМИНА =============
 
-async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений"""
-    user_id = update.effective_user.id
-    text = update.message.text
+# Новые жалобы копятся здесь и уходят админу одним сообщением раз в 2 секунды,
+# чтобы волна жалоб не упиралась в лимит Telegram на сообщения в один чат.
+_pending_admin_digest: list[str] = []
+_admin_digest_lock = asyncio.Lock()
 
-    # ========== ДЛЯ ОБЫЧНЫХ ПОЛЬЗОВАТЕЛЕЙ ==========
-    if context.user_data.get('awaiting_report'):
-        context.user_data['awaiting_report'] = False
 
-        # Дополнительная проверка перед отправкой
-        if db.is_user_banned(user_id):
-            await update.message.reply_text("⛔ Доступ заблокирован.")
-            return
+async def queue_admin_report(entry: str):
+    """Поставить жалобу в очередь уведомлений админа"""
+    async with _admin_digest_lock:
+        _pending_admin_digest.append(entry)
 
-        reports_today = db.count_user_reports_today(user_id)
-        if reports_today >= 5:
-            await update.message.reply_text("⚠️ Лимит жалоб исчерпан на сегодня.")
-            return
 
-        # Проверка длины сообщения
-        if len(text) < 10:
-            await update.message.reply_text(
-                "❌ Сообщение слишком короткое.\n"
-                "Минимум 10 символов. Попробуйте еще раз: /report"
-            )
+async def flush_admin_digest(context: ContextTypes.DEFAULT_TYPE):
+    """Отправить админу накопившиеся жалобы (задача JobQueue, раз в 2 секунды)"""
+    async with _admin_digest_lock:
+        if not _pending_admin_digest:
             return
+        entries = _pending_admin_digest[:]
+        _pending_admin_digest.clear()
+
+    # Режем на части по лимиту длины сообщения Telegram (4096 символов)
+    chunks = []
+    current = f"📨 {len(entries)} новых жалоб:"
+    for entry in entries:
+        if len(current) + len(entry) + 2 > 4000:
+            chunks.append(current)
+            current = entry
+        else:
+            current += "\n\n" + entry
+    chunks.append(current)
 
-        if len(text) > 1000:
-            await update.message.reply_text(
-                "❌ Сообщение слишком длинное.\n"
-                "Максимум 1000 символов."
-            )
-            return
+    for chunk in chunks:
+        try:
+            await context.bot.send_message(chat_id=config.ADMIN_ID, text=chunk)
+        except Exception as e:
+            logger.error(f"Не удалось уведомить админа: {e}")
 
-        username = update.effective_user.username or update.effective_user.first_name
 
-        try:
-            db.add_report(user_id, username, text)
+# ============= ОБРАБОТЧИКИ СООБЩЕНИЙ В РЕЖИМЕ ОЖИДАНИЯ =============
 
-            remaining = 5 - reports_today - 1
+class AwaitingFilter(filters.UpdateFilter):
+    """Пропускает сообщение, только если у пользователя выставлен флаг ожидания в user_data.
 
-            await update.message.reply_text(
-                f"✅ *Ваше сообщение отправлено администрации!*\n\n"
-                f"Мы рассмотрим его в ближайшее время.\n\n"
-                f"Осталось жалоб сегодня: *{remaining}/5*",
-                parse_mode='Markdown'
-            )
+    Состояние хранится в application.user_data, поэтому фильтр проверяет его
+    ещё на этапе выбора обработчика: обычные сообщения без флага не доходят до кода.
+    """
 
-            # Уведомляем админа
-            try:
-                await context.bot.send_message(
-                    chat_id=config.ADMIN_ID,
-                    text=f"⚠️ *Новая жалоба #{reports_today + 1}*\n\n"
-                         f"От: @{username}\n"
-                         f"ID: `{user_id}`\n"
-                         f"Жалоб сегодня: {reports_today + 1}/5\n\n"
-                         f"{text}",
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                logger.error(f"Не удалось уведомить админа: {e}")
-        except Exception as e:
-            logger.error(f"Ошибка добавления жалобы: {e}")
-            await update.message.reply_text("❌ Произошла ошибка. Попробуйте позже.")
+    def __init__(self, application: Application, key: str, value=None):
+        super().__init__(name=f"AwaitingFilter({key}={value!r})")
+        self._user_data = application.user_data
+        self.key = key
+        self.value = value
+
+    def filter(self, update: Update) -> bool:
+        user = update.effective_user
+        if user is None:
+            return False
+        data = self._user_data.get(user.id)
+        if not data:
+            return False
+        current = data.get(self.key)
+        if self.value is None:
+            return bool(current)
+        return current == self.value
+
+
+async def report_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Текст жалобы от пользователя"""
+    user_id = update.effective_user.id
+    text = update.message.text
+
+    context.user_data['awaiting_report'] = False
 
+    # Дополнительная проверка перед отправкой
+    if await asyncio.to_thread(db.is_user_banned, user_id):
+        await update.message.reply_text("⛔ Доступ заблокирован.")
         return
 
-    # ========== ТОЛЬКО ДЛЯ АДМИНА ДАЛЬШЕ ==========
-    if not is_admin(user_id):
+    reports_today = await asyncio.to_thread(db.count_user_reports_today, user_id)
+    if reports_today >= 5:
+        await update.message.reply_text("⚠️ Лимит жалоб исчерпан на сегодня.")
         return
 
-    # Рассылка всем
-    if context.user_data.get('awaiting_broadcast') == 'all':
-        context.user_data['awaiting_broadcast'] = None
-        users = db.get_all_users()
-        sent = 0
-        failed = 0
-        await update.message.reply_text(f"📤 Начинаю рассылку для {len(users)} пользователей...")
-        for target_user_id in users:
-            ok = await send_any_message(context.bot, target_user_id, update.message)
-            if ok:
-                sent += 1
-            else:
-                failed += 1
-            import asyncio
-            await asyncio.sleep(0.05)
-        await update.message.reply_text(f"✅ Рассылка завершена!\n\n📤 Отправлено: {sent}\n❌ Ошибок: {failed}")
+    # Проверка длины сообщения
+    if len(text) < 10:
+        await update.message.reply_text(
+            "❌ Сообщение слишком короткое.\n"
+            "Минимум 10 символов. Попробуйте еще раз: /report"
+        )
         return
 
-    # Рассылка одному
-    if context.user_data.get('awaiting_broadcast') == 'one_waiting_id':
-        msg_text = getattr(update.message, 'text', None)
-        if msg_text is None or not msg_text.strip().isdigit():
-            await update.message.reply_text('❌ Введите корректный числовой USER_ID')
-            return
-        context.user_data['broadcast_one_target'] = int(msg_text.strip())
-        context.user_data['awaiting_broadcast'] = 'one_waiting_msg'
+    if len(text) > 1000:
         await update.message.reply_text(
-            f'✅ ID `{msg_text.strip()}` принят.\n'
-            'Шаг 2: теперь отправьте сообщение любого типа для этого пользователя.',
-            parse_mode='Markdown'
+            "❌ Сообщение слишком длинное.\n"
+            "Максимум 1000 символов."
         )
         return
 
-    elif context.user_data.get('awaiting_broadcast') == 'one_waiting_msg':
-        target_user_id = context.user_data.pop('broadcast_one_target', None)
-        context.user_data['awaiting_broadcast'] = None
-        if target_user_id is None:
-            await update.message.reply_text('❌ ID не найден, начните заново.')
-            return
+    username = update.effective_user.username or update.effective_user.first_name
+
+    try:
+        await asyncio.to_thread(db.add_report, user_id, username, text)
+
+        remaining = 5 - reports_today - 1
+
+        await update.message.reply_text(
+            f"✅ *Ваше сообщение отправлено администрации!*\n\n"
+            f"Мы рассмотрим его в ближайшее время.\n\n"
+            f"Осталось жалоб сегодня: *{remaining}/5*",
+            parse_mode='Markdown'
+        )
+
+        # Уведомляем админа (уйдёт в ближайшем дайджесте)
+        await queue_admin_report(
+            f"⚠️ Жалоба от @{username} (ID: {user_id}), "
+            f"сегодня {reports_today + 1}/5:\n{text}"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка добавления жалобы: {e}")
+        await update.message.reply_text("❌ Произошла ошибка. Попробуйте позже.")
+
+
+async def broadcast_all_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка всем пользователям"""
+    context.user_data['awaiting_broadcast'] = None
+    users = await asyncio.to_thread(db.get_all_users)
+    sent = 0
+    failed = 0
+    await update.message.reply_text(f"📤 Начинаю рассылку для {len(users)} пользователей...")
+    for target_user_id in users:
         ok = await send_any_message(context.bot, target_user_id, update.message)
         if ok:
-            await update.message.reply_text(f'✅ Сообщение отправлено пользователю {target_user_id}')
+            sent += 1
         else:
-            await update.message.reply_text(f'❌ Ошибка отправки пользователю {target_user_id}')
-        return
+            failed += 1
+        await asyncio.sleep(0.05)
+    await update.message.reply_text(f"✅ Рассылка завершена!\n\n📤 Отправлено: {sent}\n❌ Ошибок: {failed}")
 
-    # Рассылка нескольким
-    if context.user_data.get('awaiting_broadcast') == 'multiple_waiting_ids':
-        msg_text = getattr(update.message, 'text', '')
-        if not msg_text:
-            await update.message.reply_text('❌ Введите ID через пробел')
-            return
-        ids = [int(x) for x in msg_text.strip().split() if x.strip().isdigit()]
-        if not ids:
-            await update.message.reply_text('❌ Не найдено ни одного корректного ID')
-            return
-        context.user_data['broadcast_multiple_targets'] = ids
-        context.user_data['awaiting_broadcast'] = 'multiple_waiting_msg'
-        await update.message.reply_text(
-            f'✅ Принято {len(ids)} ID.\n'
-            'Шаг 2: отправьте сообщение любого типа для рассылки.'
-        )
+
+async def broadcast_one_id_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка одному: шаг 1, ввод USER_ID"""
+    msg_text = getattr(update.message, 'text', None)
+    if msg_text is None or not msg_text.strip().isdigit():
+        await update.message.reply_text('❌ Введите корректный числовой USER_ID')
         return
+    context.user_data['broadcast_one_target'] = int(msg_text.strip())
+    context.user_data['awaiting_broadcast'] = 'one_waiting_msg'
+    await update.message.reply_text(
+        f'✅ ID `{msg_text.strip()}` принят.\n'
+        'Шаг 2: теперь отправьте сообщение любого типа для этого пользователя.',
+        parse_mode='Markdown'
+    )
 
-    elif context.user_data.get('awaiting_broadcast') == 'multiple_waiting_msg':
-        ids = context.user_data.pop('broadcast_multiple_targets', [])
-        context.user_data['awaiting_broadcast'] = None
-        sent = 0
-        for target_user_id in ids:
-            ok = await send_any_message(context.bot, target_user_id, update.message)
-            if ok:
-                sent += 1
-            import asyncio
-            await asyncio.sleep(0.05)
-        await update.message.reply_text(f'✅ Отправлено {sent} из {len(ids)} пользователям')
+
+async def broadcast_one_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка одному: шаг 2, само сообщение"""
+    target_user_id = context.user_data.pop('broadcast_one_target', None)
+    context.user_data['awaiting_broadcast'] = None
+    if target_user_id is None:
+        await update.message.reply_text('❌ ID не найден, начните заново.')
         return
+    ok = await send_any_message(context.bot, target_user_id, update.message)
+    if ok:
+        await update.message.reply_text(f'✅ Сообщение отправлено пользователю {target_user_id}')
+    else:
+        await update.message.reply_text(f'❌ Ошибка отправки пользователю {target_user_id}')
 
-    # Удаление пользователя
-    if context.user_data.get('awaiting_delete_user'):
-        context.user_data['awaiting_delete_user'] = False
 
-        try:
-            target_user_id = int(text.strip())
-            db.delete_user_data(target_user_id)
-            await update.message.reply_text(f"✅ Пользователь {target_user_id} удален")
-        except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка: {e}")
+async def broadcast_multiple_ids_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка нескольким: шаг 1, ввод списка ID"""
+    msg_text = getattr(update.message, 'text', '')
+    if not msg_text:
+        await update.message.reply_text('❌ Введите ID через пробел')
         return
+    ids = [int(x) for x in msg_text.strip().split() if x.strip().isdigit()]
+    if not ids:
+        await update.message.reply_text('❌ Не найдено ни одного корректного ID')
+        return
+    context.user_data['broadcast_multiple_targets'] = ids
+    context.user_data['awaiting_broadcast'] = 'multiple_waiting_msg'
+    await update.message.reply_text(
+        f'✅ Принято {len(ids)} ID.\n'
+        'Шаг 2: отправьте сообщение любого типа для рассылки.'
+    )
 
-    # Выдача монет
-    if context.user_data.get('awaiting_give_coins'):
-        context.user_data['awaiting_give_coins'] = False
 
-        try:
-            parts = text.split()
-            target_user_id = int(parts[0])
-            amount = int(parts[1])
+async def broadcast_multiple_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка нескольким: шаг 2, само сообщение"""
+    ids = context.user_data.pop('broadcast_multiple_targets', [])
+    context.user_data['awaiting_broadcast'] = None
+    sent = 0
+    for target_user_id in ids:
+        ok = await send_any_message(context.bot, target_user_id, update.message)
+        if ok:
+            sent += 1
+        await asyncio.sleep(0.05)
+    await update.message.reply_text(f'✅ Отправлено {sent} из {len(ids)} пользователям')
 
-            db.add_coins(target_user_id, amount)
-            await update.message.reply_text(f"✅ Выдано {amount} монет пользователю {target_user_id}")
 
-            try:
-                await context.bot.send_message(
-                    chat_id=target_user_id,
-                    text=f"🎁 Вам начислено {amount} монет от администрации!"
-                )
-            except:
-                pass
-        except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка: {e}")
-        return
+async def delete_user_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Удаление пользователя по введённому ID"""
+    text = update.message.text
 
-    # Ответ на жалобу
-    if context.user_data.get('awaiting_reply'):
-        data = context.user_data['awaiting_reply']
-        context.user_data['awaiting_reply'] = None
+    context.user_data['awaiting_delete_user'] = False
 
-        report_id = data['report_id']
-        target_user_id = data['user_id']
+    try:
+        target_user_id = int(text.strip())
+        await asyncio.to_thread(db.delete_user_data, target_user_id)
+        await update.message.reply_text(f"✅ Пользователь {target_user_id} удален")
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка: {e}")
 
-        db.update_report_status(report_id, 'answered', text)
 
-        try:
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text=f"✉️ *Ответ от Администрации:*\n\n{text}",
-                parse_mode='Markdown'
-            )
-            await update.message.reply_text("✅ Ответ отправлен пользователю")
-        except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка отправки: {e}")
-        return
+async def give_coins_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выдача монет по строке вида USER_ID КОЛИЧЕСТВО"""
+    text = update.message.text
+
+    context.user_data['awaiting_give_coins'] = False
 
-    # Предупреждение
-    if context.user_data.get('awaiting_warning'):
-        data = context.user_data['awaiting_warning']
-        context.user_data['awaiting_warning'] = None
+    try:
+        parts = text.split()
+        target_user_id = int(parts[0])
+        amount = int(parts[1])
 
-        report_id = data['report_id']
-        target_user_id = data['user_id']
+        await asyncio.to_thread(db.add_coins, target_user_id, amount)
+        await update.message.reply_text(f"✅ Выдано {amount} монет пользователю {target_user_id}")
 
-        db.add_warning(target_user_id)
-        db.update_report_status(report_id, 'warned', text)
+        await send_message_safe(
+            context.bot, target_user_id,
+            f"🎁 Вам начислено {amount} монет от администрации!"
+        )
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка: {e}")
 
-        try:
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text=f"⚠️ *ПРЕДУПРЕЖДЕНИЕ от Администрации:*\n\n{text}",
-                parse_mode='Markdown'
-            )
-            await update.message.reply_text("✅ Предупреждение выдано")
-        except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка: {e}")
-        return
+
+async def reply_report_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ответ админа на жалобу"""
+    text = update.message.text
+
+    data = context.user_data['awaiting_reply']
+    context.user_data['awaiting_reply'] = None
+
+    report_id = data['report_id']
+    target_user_id = data['user_id']
+
+    await asyncio.to_thread(db.update_report_status, report_id, 'answered', text)
+
+    try:
+        await context.bot.send_message(
+            chat_id=target_user_id,
+            text=f"✉️ *Ответ от Администрации:*\n\n{text}",
+            parse_mode='Markdown'
+        )
+        await update.message.reply_text("✅ Ответ отправлен пользователю")
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка отправки: {e}")
+
+
+async def warn_report_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Предупреждение пользователю по жалобе"""
+    text = update.message.text
+
+    data = context.user_data['awaiting_warning']
+    context.user_data['awaiting_warning'] = None
+
+    report_id = data['report_id']
+    target_user_id = data['user_id']
+
+    await asyncio.to_thread(db.warn_and_close_report, target_user_id, report_id, text)
+
+    try:
+        await context.bot.send_message(
+            chat_id=target_user_id,
+            text=f"⚠️ *ПРЕДУПРЕЖДЕНИЕ от Администрации:*\n\n{text}",
+            parse_mode='Markdown'
+        )
+        await update.message.reply_text("✅ Предупреждение выдано")
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка: {e}")
 
 
 # ============= ЖАЛОБА ДЛЯ ОБЫЧНЫХ ПОЛЬЗОВАТЕЛЕЙ =============
@@ -1438,7 +1481,7 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     # Проверка на бан (3+ предупреждений)
-    if db.is_user_banned(user_id):
+    if await asyncio.to_thread(db.is_user_banned, user_id):
         await update.message.reply_text(
             "⛔ *Доступ к отправке жалоб заблокирован*\n\n"
             "У вас 3 или более предупреждений.\n"
@@ -1448,7 +1491,7 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Проверка лимита жалоб за день (макс 5)
-    reports_today = db.count_user_reports_today(user_id)
+    reports_today = await asyncio.to_thread(db.count_user_reports_today, user_id)
     if reports_today >= 5:
         await update.message.reply_text(
             "⚠️ *Лимит жалоб исчерпан*\n\n"
@@ -1459,7 +1502,7 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Проверка на спам (минимум 1 минута между жалобами)
-    last_report = db.get_last_report_time(user_id)
+    last_report = await asyncio.to_thread(db.get_last_report_time, user_id)
     if last_report:
         from datetime import datetime, timedelta
         try:
@@ -1508,24 +1551,25 @@ async def shop_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query:
         await query.answer()
     user_id = query.from_user.id if query else update.effective_user.id
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     coins = user['coins'] if user else 0
     today = _today_minsk()
+    today_iso = today.isoformat()
 
     freeze_until = user.get('streak_freeze_until') if user else None
     double_until = user.get('double_coins_until') if user else None
     last_coinflip = user.get('lastcoinflipdate') if user else None
 
     freeze_status = ""
-    if freeze_until and date.fromisoformat(freeze_until) >= today:
+    if freeze_until and _parse_date(freeze_until) >= today:
         freeze_status = f" ✅ _(до {freeze_until})_"
 
     double_status = ""
-    if double_until and date.fromisoformat(double_until) >= today:
+    if double_until and _parse_date(double_until) >= today:
         double_status = f" ✅ _(до {double_until})_"
 
     coinflip_status = ""
-    if last_coinflip == today.isoformat():
+    if last_coinflip == today_iso:
         coinflip_status = " ✅ _(сыграно сегодня)_"
 
     text = (
@@ -1573,7 +1617,7 @@ async def buy_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     action = query.data
 
     if action == 'buy_freeze_1':
-        result = db.buy_streak_freeze(user_id, days=1, cost=50)
+        result = await asyncio.to_thread(db.buy_streak_freeze, user_id, days=1, cost=50)
         if result['success']:
             text = (
                 "✅ *Заморозка куплена!*\n\n"
@@ -1584,7 +1628,7 @@ async def buy_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text = f"❌ {result['message']}"
 
     elif action == 'buy_freeze_3':
-        result = db.buy_streak_freeze(user_id, days=3, cost=120)
+        result = await asyncio.to_thread(db.buy_streak_freeze, user_id, days=3, cost=120)
         if result['success']:
             text = (
                 "✅ *Заморозка куплена!*\n\n"
@@ -1595,7 +1639,7 @@ async def buy_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text = f"❌ {result['message']}"
 
     elif action == 'buy_double':
-        result = db.buy_double_coins(user_id, cost=50)
+        result = await asyncio.to_thread(db.buy_double_coins, user_id, cost=50)
         if result['success']:
             text = (
                 "✅ *x2 монеты активированы!*\n\n"
@@ -1608,15 +1652,47 @@ async def buy_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         text = "❌ Неизвестный товар"
 
-    keyboard = [[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(text, reply_markup=_BACK_TO_SHOP_KB, parse_mode='Markdown')
 
 
 # ============= КОИНФЛИП =============
 
-# In-memory set: защита от double-click в момент ожидания анимации кубика.
+# Per-user asyncio.Lock: защита от double-click в момент ожидания анимации кубика.
+# Захватывается в coinflip_choice_handler, отпускается в _coinflip_resolve.
 # Работает в рамках одного процесса (Railway — один инстанс).
-_coinflip_in_progress: set = set()
+_coinflip_locks: dict[int, asyncio.Lock] = {}
+# Когда блокировка была захвачена (time.monotonic()) — для вычистки зависших
+_coinflip_locked_at: dict[int, float] = {}
+COINFLIP_LOCK_TTL = 30  # секунд; сама игра занимает ~4 сек
+
+
+def _release_coinflip_lock(user_id: int, lock: asyncio.Lock) -> bool:
+    """
+    Отпустить блокировку коинфлипа, захваченную этой игрой. Забываем её, только если
+    она всё ещё текущая: после вычистки зависшей новая игра могла взять свою.
+    Возвращает True, если блокировка была текущей.
+    """
+    owned = _coinflip_locks.get(user_id) is lock
+    if owned:
+        del _coinflip_locks[user_id]
+        _coinflip_locked_at.pop(user_id, None)
+    if lock.locked():
+        lock.release()
+    return owned
+
+
+async def evict_stale_coinflip_locks(context: ContextTypes.DEFAULT_TYPE):
+    """Снять блокировки коинфлипа, которые висят дольше COINFLIP_LOCK_TTL"""
+    cutoff = time.monotonic() - COINFLIP_LOCK_TTL
+    stale = [uid for uid, locked_at in _coinflip_locked_at.items() if locked_at < cutoff]
+    for uid in stale:
+        lock = _coinflip_locks.get(uid)
+        if lock is not None:
+            _release_coinflip_lock(uid, lock)
+        user_data = context.application.user_data.get(uid)
+        if user_data:
+            user_data.pop('coinflip_bet', None)
+        logger.info(f"[COINFLIP] evicted stale lock user={uid}")
 
 
 async def coinflip_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1624,13 +1700,12 @@ async def coinflip_menu_handler(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
 
     if not user:
-        keyboard = [[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]]
         await query.edit_message_text(
             "❌ Пользователь не найден.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=_BACK_TO_SHOP_KB
         )
         return
 
@@ -1645,9 +1720,8 @@ async def coinflip_menu_handler(update: Update, context: ContextTypes.DEFAULT_TY
             "❌ Ты уже играл в коинфлип сегодня.\n\n"
             "Попробуй снова завтра — попытка обновляется каждый день в 00:00 🕐"
         )
-        keyboard = [[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]]
         await query.edit_message_text(
-            text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown'
+            text, reply_markup=_BACK_TO_SHOP_KB, parse_mode='Markdown'
         )
         return
 
@@ -1659,9 +1733,8 @@ async def coinflip_menu_handler(update: Update, context: ContextTypes.DEFAULT_TY
             "Минимальная ставка: *5 монет* 🪙\n\n"
             "Выполняй челленджи, чтобы заработать монеты! 💪"
         )
-        keyboard = [[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]]
         await query.edit_message_text(
-            text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown'
+            text, reply_markup=_BACK_TO_SHOP_KB, parse_mode='Markdown'
         )
         return
 
@@ -1703,21 +1776,19 @@ async def coinflip_bet_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     bet = int(query.data.replace('coinflip_bet_', ''))
 
     # Повторная проверка баланса и даты (мог пройти некоторый период)
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     if not user:
-        keyboard = [[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]]
         await query.edit_message_text(
             "❌ Ошибка. Попробуй снова.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=_BACK_TO_SHOP_KB
         )
         return
 
     today = _today_minsk().isoformat()
     if user.get('lastcoinflipdate') == today:
-        keyboard = [[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]]
         await query.edit_message_text(
             "🎲 *Коинфлип*\n\n❌ Ты уже играл сегодня. Приходи завтра!",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=_BACK_TO_SHOP_KB,
             parse_mode='Markdown'
         )
         return
@@ -1770,32 +1841,49 @@ async def coinflip_cancel_handler(update: Update, context: ContextTypes.DEFAULT_
 async def coinflip_choice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Пользователь выбрал исход (high/low) — бросаем кубик и подводим итог"""
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
 
-    # --- Anti-double-click: проверяем in-progress ---
-    if user_id in _coinflip_in_progress:
+    # Callback отвечаем ровно один раз: ошибки — всплывающим alert'ом вместо
+    # отдельного editMessageText, успешный путь — пустым ответом
+
+    # --- Anti-double-click: проверяем, не идёт ли уже игра ---
+    lock = _coinflip_locks.setdefault(user_id, asyncio.Lock())
+    if lock.locked():
         await query.answer("⏳ Кубик уже брошен, подожди результата!", show_alert=True)
         return
 
     bet = context.user_data.get('coinflip_bet')
     if bet is None:
         # Ставка не найдена — устаревшее состояние (напр. после перезапуска бота)
-        keyboard = [[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]]
-        await query.edit_message_text(
-            "❌ Ставка не найдена. Начни игру заново.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        _coinflip_locks.pop(user_id, None)
+        await query.answer("❌ Ставка не найдена. Начни игру заново.", show_alert=True)
         return
 
     choice = query.data  # 'coinflip_high' или 'coinflip_low'
     choice_text = "🔼 Больше 3" if choice == 'coinflip_high' else "🔽 3 или меньше"
 
     # Блокируем повторные нажатия на время анимации
-    _coinflip_in_progress.add(user_id)
+    await lock.acquire()
+    _coinflip_locked_at[user_id] = time.monotonic()
+    resolve_scheduled = False
+    game_id = None
 
     try:
-        # 1. Убираем кнопки немедленно (UI-защита от двойного клика)
+        # 1. Атомарная проверка в БД + фиксация даты (lock против повторной игры)
+        start_result = await asyncio.to_thread(db.coinflip_start, user_id, bet)
+        if not start_result['success']:
+            logger.warning(
+                f"[COINFLIP] User {user_id} coinflip_start rejected: {start_result['message']}"
+            )
+            # В alert Markdown не рендерится — убираем звёздочки
+            await query.answer(f"❌ {start_result['message']}".replace('*', ''), show_alert=True)
+            return
+
+        game_id = start_result['game_id']
+        await query.answer()
+        logger.info(f"[COINFLIP] User {user_id} game started: bet={bet}, choice={choice}")
+
+        # 2. Убираем кнопки (UI-защита от двойного клика)
         await query.edit_message_text(
             f"🎲 *Коинфлип*\n\n"
             f"💰 Ставка: *{bet} монет*\n"
@@ -1805,22 +1893,6 @@ async def coinflip_choice_handler(update: Update, context: ContextTypes.DEFAULT_
             # Без reply_markup — кнопки убраны
         )
 
-        # 2. Атомарная проверка в БД + фиксация даты (lock против повторной игры)
-        start_result = db.coinflip_start(user_id, bet)
-        if not start_result['success']:
-            logger.warning(
-                f"[COINFLIP] User {user_id} coinflip_start rejected: {start_result['message']}"
-            )
-            keyboard = [[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]]
-            await query.edit_message_text(
-                f"❌ {start_result['message']}",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-            return
-
-        logger.info(f"[COINFLIP] User {user_id} game started: bet={bet}, choice={choice}")
-
         # 3. Бросаем кубик — sendDice отправляет анимацию отдельным сообщением
         dice_msg = await context.bot.send_dice(
             chat_id=query.message.chat_id,
@@ -1830,9 +1902,71 @@ async def coinflip_choice_handler(update: Update, context: ContextTypes.DEFAULT_
 
         logger.info(f"[COINFLIP] User {user_id} dice rolled: value={dice_value}")
 
-        # 4. Ждём окончания анимации кубика (~4 сек)
-        await asyncio.sleep(4)
+        # 4. Итог подводим после анимации кубика (~4 сек) отдельной задачей JobQueue,
+        #    чтобы обработчик не держал воркер всё это время
+        context.job_queue.run_once(
+            _coinflip_resolve,
+            when=4,
+            data={
+                'game_id': game_id,
+                'bet': bet,
+                'choice': choice,
+                'choice_text': choice_text,
+                'dice_value': dice_value,
+                'lock': lock,
+            },
+            chat_id=query.message.chat_id,
+            user_id=user_id,
+            name=f'cf_{user_id}',
+        )
+        resolve_scheduled = True
+
+    except Exception as e:
+        logger.error(f"[COINFLIP] User {user_id} unexpected error: {e}", exc_info=True)
+        text = "❌ Произошла ошибка во время игры. Попробуй позже."
+        # Ставка уже списана, но итог не запланирован — возвращаем её сразу, а не при перезапуске
+        if game_id is not None and not resolve_scheduled:
+            refund_result = await asyncio.to_thread(db.coinflip_refund, user_id, game_id)
+            if refund_result['success']:
+                text = "❌ Произошла ошибка во время игры. Ставка возвращена, попробуй ещё раз."
+            else:
+                logger.error(
+                    f"[COINFLIP] User {user_id} coinflip_refund FAILED: {refund_result['message']}"
+                )
+        try:
+            await context.bot.send_message(
+                chat_id=query.message.chat_id,
+                text=text,
+                reply_markup=_TO_SHOP_KB
+            )
+        except Exception:
+            pass
+
+    finally:
+        # Если итог уже запланирован — блокировку снимет _coinflip_resolve
+        if not resolve_scheduled and _release_coinflip_lock(user_id, lock):
+            context.user_data.pop('coinflip_bet', None)
+
+
+# Статичные Markdown-фрагменты итога: (заголовок, шаблон строки с монетами)
+_COINFLIP_OUTCOMES = {
+    True: ("🎉 *Ты угадал! Победа!*\n\n", "Выигрыш: *+{bet} монет* 💰\n"),
+    False: ("😔 *Не угадал. Удачи в следующий раз!*\n\n", "Проигрыш: *−{bet} монет* 💸\n"),
+}
+
 
+async def _coinflip_resolve(context: ContextTypes.DEFAULT_TYPE):
+    """Вторая половина коинфлипа: подводим итог после анимации кубика"""
+    job = context.job
+    user_id = job.user_id
+    chat_id = job.chat_id
+    game_id = job.data['game_id']
+    bet = job.data['bet']
+    choice = job.data['choice']
+    choice_text = job.data['choice_text']
+    dice_value = job.data['dice_value']
+
+    try:
         # 5. Определяем победителя
         if choice == 'coinflip_high':
             won = dice_value > 3
@@ -1840,41 +1974,29 @@ async def coinflip_choice_handler(update: Update, context: ContextTypes.DEFAULT_
             won = dice_value <= 3
 
         # 6. Применяем изменение монет в БД
-        finish_result = db.coinflip_finish(user_id, bet, won)
+        finish_result = await asyncio.to_thread(db.coinflip_finish, user_id, game_id, won)
 
         if not finish_result['success']:
             logger.error(
                 f"[COINFLIP] User {user_id} coinflip_finish FAILED: {finish_result['message']}"
             )
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=(
-                    "⚠️ Кубик брошен, но произошла ошибка при обновлении баланса.\n"
-                    "Свяжись с поддержкой — твои монеты в безопасности. 🙏"
-                ),
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("◀️ В магазин", callback_data='shop')]]
-                )
-            )
+            context.application.create_task(send_message_safe(
+                context.bot, chat_id,
+                "⚠️ Кубик брошен, но произошла ошибка при обновлении баланса.\n"
+                "Свяжись с поддержкой — твои монеты в безопасности. 🙏",
+                reply_markup=_TO_SHOP_KB
+            ))
             return
 
         new_coins = finish_result['new_coins']
 
         # 7. Формируем результат
-        if won:
-            result_emoji = "🎉"
-            result_header = "Ты угадал! Победа!"
-            coins_line = f"Выигрыш: *+{bet} монет* 💰"
-        else:
-            result_emoji = "😔"
-            result_header = "Не угадал. Удачи в следующий раз!"
-            coins_line = f"Проигрыш: *−{bet} монет* 💸"
-
+        result_header, coins_template = _COINFLIP_OUTCOMES[won]
         result_text = (
             f"🎲 Выпало: *{dice_value}*\n\n"
-            f"{result_emoji} *{result_header}*\n\n"
+            f"{result_header}"
             f"Твой выбор: *{choice_text}*\n"
-            f"{coins_line}\n"
+            f"{coins_template.format(bet=bet)}"
             f"Баланс: *{new_coins} монет* 🪙"
         )
 
@@ -1883,31 +2005,25 @@ async def coinflip_choice_handler(update: Update, context: ContextTypes.DEFAULT_
             f"won={won}, bet={bet}, new_coins={new_coins}"
         )
 
-        keyboard = [[InlineKeyboardButton("◀️ Назад в магазин", callback_data='shop')]]
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=result_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+        # Отправляем в фоне: ретраи сети не держат блокировку коинфлипа
+        context.application.create_task(send_message_safe(
+            context.bot, chat_id, result_text,
+            reply_markup=_BACK_TO_SHOP_KB,
             parse_mode='Markdown'
-        )
+        ))
 
     except Exception as e:
         logger.error(f"[COINFLIP] User {user_id} unexpected error: {e}", exc_info=True)
-        try:
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text="❌ Произошла ошибка во время игры. Попробуй позже.",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("◀️ В магазин", callback_data='shop')]]
-                )
-            )
-        except Exception:
-            pass
+        context.application.create_task(send_message_safe(
+            context.bot, chat_id,
+            "❌ Произошла ошибка во время игры. Попробуй позже.",
+            reply_markup=_TO_SHOP_KB
+        ))
 
     finally:
-        # Всегда снимаем блокировку и чистим ставку
-        _coinflip_in_progress.discard(user_id)
-        context.user_data.pop('coinflip_bet', None)
+        # Всегда снимаем свою блокировку; ставку чистим, только если новая игра не началась
+        if _release_coinflip_lock(user_id, job.data['lock']):
+            context.user_data.pop('coinflip_bet', None)
 
 
 async def back_to_main_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1915,58 +2031,45 @@ async def back_to_main_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
     user = query.from_user
 
-    keyboard = [
-        [InlineKeyboardButton("🎯 Получить челлендж", callback_data='back_to_categories')],
-        [InlineKeyboardButton("👤 Профиль", callback_data='profile')],
-        [InlineKeyboardButton("🛒 Магазин", callback_data='shop')],
-    ]
     await query.edit_message_text(
         f"👋 Привет, *{user.first_name}*!\n\nВыбери действие:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_MAIN_MENU_KB,
         parse_mode='Markdown'
     )
 
 
+_LEADERBOARD_MEDALS = ('🥇', '🥈', '🥉')
+_LEADERBOARD_HEADER = "🏆 *Топ игроков по стрику*\n\n"
+# В топ попадают только активные стрики (streak > 0)
+_LEADERBOARD_EMPTY = "🥇 *Топ игроков*\n\nСейчас ни у кого нет активного стрика. Выполни челлендж и займи первое место!"
+
+
 async def leaderboard_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Топ игроков"""
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
 
-    top = db.get_leaderboard()
+    top = await asyncio.to_thread(db.get_leaderboard)
 
     if not top:
-        text = "🥇 *Топ игроков*\n\nПока никто не выполнил ни одного челленджа. Будь первым!"
+        text = _LEADERBOARD_EMPTY
     else:
-        medals = ['🥇', '🥈', '🥉']
-        lines = ["🏆 *Топ игроков по стрику*\n"]
-
-        for i, user in enumerate(top):
-            medal = medals[i] if i < 3 else f"{i + 1}."
-            name = user['first_name'] or user['username'] or 'Игрок'
-            streak = user['streak']
-            total = user['total_completed']
-
-            # Подсвечиваем текущего пользователя
-            current_user = db.get_user(user_id)
-            is_me = (
-                current_user and
-                current_user['first_name'] == user['first_name'] and
-                current_user['streak'] == streak
-            )
-            marker = " ← ты" if is_me else ""
-
-            lines.append(f"{medal} *{name}* — 🔥 {streak} дней | ✅ {total}{marker}")
-
-        text = "\n".join(lines)
-
-    keyboard = [
-        [InlineKeyboardButton("◀️ Назад в профиль", callback_data='profile')],
-    ]
+        # Имя стоит внутри *...*: в legacy Markdown экранирование внутри сущности не работает,
+        # '_' и прочие символы там и так литеральные — опасна только '*', она закрыла бы жирный.
+        # Поэтому заменяем её на похожую '∗'. Текущего пользователя подсвечиваем маркером « ← ты»
+        body = "\n".join(
+            f"{_LEADERBOARD_MEDALS[i] if i < 3 else f'{i + 1}.'} "
+            f"*{(user['first_name'] or user['username'] or 'Игрок').replace('*', '∗')}* — "
+            f"🔥 {user['streak']} дней | ✅ {user['total_completed']}"
+            f"{' ← ты' if user['user_id'] == user_id else ''}"
+            for i, user in enumerate(top)
+        )
+        text = _LEADERBOARD_HEADER + body
 
     await query.edit_message_text(
         text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_BACK_TO_PROFILE_KB,
         parse_mode='Markdown'
     )
 
@@ -1979,43 +2082,138 @@ async def admin_back_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not is_admin(query.from_user.id):
         return
 
-    keyboard = [
-        [InlineKeyboardButton("📊 Статистика бота", callback_data='admin_stats')],
-        [InlineKeyboardButton("👥 Список пользователей", callback_data='admin_users')],
-        [InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast_menu')],
-        [InlineKeyboardButton("🗑️ Удалить пользователя", callback_data='admin_delete_menu')],
-        [InlineKeyboardButton("💰 Выдать монеты", callback_data='admin_give_coins')],
-        [InlineKeyboardButton("⚠️ Жалобы пользователей", callback_data='admin_reports')],
-    ]
-
     await query.edit_message_text(
         "🔐 *Админ-панель*\n\nВыберите действие:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_ADMIN_MENU_KB,
         parse_mode='Markdown'
     )
 
 
+# ============= МАРШРУТИЗАЦИЯ CALLBACK =============
+
+# Точные значения callback_data
+CALLBACK_ROUTES = {
+    # Обычные
+    'complete': complete_handler,
+    'another': another_challenge_handler,
+    'stats': stats_handler,
+    'achievements': achievements_handler,
+    'back_to_categories': back_to_categories_handler,
+    'shop': shop_handler,
+    'back_to_main': back_to_main_handler,
+    'profile': profile_handler,
+    'leaderboard': leaderboard_handler,
+    'coinflip': coinflip_menu_handler,
+    'coinflip_high': coinflip_choice_handler,
+    'coinflip_low': coinflip_choice_handler,
+    'coinflip_cancel': coinflip_cancel_handler,
+    'cancel_report': cancel_report_handler,
+    # Админ
+    'admin_stats': admin_stats_handler,
+    'admin_users': admin_users_handler,
+    'admin_broadcast_menu': admin_broadcast_menu_handler,
+    'admin_broadcast_all': admin_broadcast_all_handler,
+    'admin_broadcast_one': admin_broadcast_one_handler,
+    'admin_broadcast_multiple': admin_broadcast_multiple_handler,
+    'admin_delete_menu': admin_delete_menu_handler,
+    'admin_give_coins': admin_give_coins_handler,
+    'admin_reports': admin_reports_handler,
+    'admin_back': admin_back_handler,
+}
+
+# Callback_data с параметрами: шаблоны собираются в одну регулярку с именованными
+# группами, так что нужный обработчик находится за один проход match()
+CALLBACK_PATTERN_ROUTES = (
+    (r'cat_.+', category_handler),
+    (r'buy_.+', buy_handler),
+    (r'coinflip_bet_\d+', coinflip_bet_handler),
+    (r'admin_report_\d+', admin_report_detail_handler),
+    (r'admin_reply_.+', admin_reply_report_handler),
+    (r'admin_approve_.+', admin_approve_report_handler),
+    (r'admin_reject_.+', admin_reject_report_handler),
+    (r'admin_warn_.+', admin_warn_report_handler),
+)
+_CALLBACK_DISPATCH_RE = re.compile('|'.join(
+    f'(?P<r{i}>{pattern})' for i, (pattern, _) in enumerate(CALLBACK_PATTERN_ROUTES)
+))
+_CALLBACK_GROUP_HANDLERS = {
+    f'r{i}': handler for i, (_, handler) in enumerate(CALLBACK_PATTERN_ROUTES)
+}
+
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Единая точка входа для callback-кнопок: словарь, затем одна общая регулярка"""
+    data = update.callback_query.data or ''
+    handler = CALLBACK_ROUTES.get(data)
+    if handler is None:
+        match = _CALLBACK_DISPATCH_RE.fullmatch(data)
+        if match is None:
+            logger.warning(f"Неизвестный callback: {data!r}")
+            return
+        handler = _CALLBACK_GROUP_HANDLERS[match.lastgroup]
+    return await handler(update, context)
+
+
 def main():
     """Запуск бота"""
 
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    # Размеры согласованы: connection_pool_size >= concurrent_updates + параллельные задачи
+    # JobQueue (дайджест, коинфлип, вычистка), иначе долгие обработчики душат входящие апдейты.
+    # HTTP/2: последовательные запросы обработчика мультиплексируются в одном соединении
+    request = HTTPXRequest(
+        http_version="2",
+        connection_pool_size=64,
+        pool_timeout=20.0,
+        connect_timeout=5.0,
+        read_timeout=30.0,
+        write_timeout=30.0,
+    )
+    get_updates_request = HTTPXRequest(http_version="2", connection_pool_size=4)
+    application = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .concurrent_updates(32)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(AIORateLimiter())
+        .build()
+    )
+
+    # Партии коинфлипа, оборванные прошлым перезапуском: возвращаем ставки
+    try:
+        refunded = db.refund_pending_coinflips()
+        if refunded:
+            logger.info(f"[COINFLIP] Возвращены ставки по {refunded} незавершённым партиям")
+    except Exception as e:
+        logger.error(f"[COINFLIP] Ошибка возврата незавершённых ставок: {e}")
     # При старте бота:
     minsk_tz = pytz.timezone("Europe/Minsk")
 
-    scheduler = AsyncIOScheduler(timezone=minsk_tz)
+    # Опоздавший запуск (event loop был занят) выполняем не позже чем через час
+    # и ровно один раз: оба задания проходят по всем пользователям
+    scheduler = AsyncIOScheduler(
+        timezone=minsk_tz,
+        jobstores={'default': MemoryJobStore()},
+        executors={'default': AsyncIOExecutor()},
+        job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 3600},
+    )
     scheduler.add_job(
         check_and_reset_streaks,
         'cron',
         hour=0,
         minute=0,
-        args=[application.bot]
+        args=[application.bot],
+        id='reset_streaks',
+        replace_existing=True
     )
     scheduler.add_job(
         send_evening_reminder,
         'cron',
         hour=20,
         minute=0,
-        args=[application.bot]
+        args=[application.bot],
+        id='evening_reminder',
+        replace_existing=True
     )
     scheduler.start()
 
@@ -2030,6 +2228,11 @@ def main():
 
     application.post_init = post_init
 
+    # Дайджест новых жалоб для админа
+    application.job_queue.run_repeating(flush_admin_digest, interval=2, first=2)
+    # Вычистка зависших блокировок коинфлипа
+    application.job_queue.run_repeating(evict_stale_coinflip_locks, interval=60, first=60)
+
     # Команды
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("stats", stats_command))
@@ -2040,56 +2243,43 @@ def main():
     application.add_handler(CommandHandler("shop", shop_command))
     application.add_handler(CommandHandler("help", help_command))
 
-    # Обычные callback
-    application.add_handler(CallbackQueryHandler(category_handler, pattern='^cat_'))
-    application.add_handler(CallbackQueryHandler(complete_handler, pattern='^complete$'))
-    application.add_handler(CallbackQueryHandler(another_challenge_handler, pattern='^another$'))
-    application.add_handler(CallbackQueryHandler(stats_handler, pattern='^stats$'))
-    application.add_handler(CallbackQueryHandler(achievements_handler, pattern='^achievements$'))
-    application.add_handler(CallbackQueryHandler(back_to_categories_handler, pattern='^back_to_categories$'))
-    application.add_handler(CallbackQueryHandler(shop_handler, pattern='^shop$'))
-    application.add_handler(CallbackQueryHandler(buy_handler, pattern='^buy_'))
-    application.add_handler(CallbackQueryHandler(back_to_main_handler, pattern='^back_to_main$'))
-    application.add_handler(CallbackQueryHandler(profile_handler, pattern='^profile$'))
-    application.add_handler(CallbackQueryHandler(leaderboard_handler, pattern='^leaderboard$'))
-    application.add_handler(CallbackQueryHandler(coinflip_menu_handler, pattern='^coinflip$'))
-    application.add_handler(CallbackQueryHandler(coinflip_bet_handler, pattern='^coinflip_bet_'))
-    application.add_handler(CallbackQueryHandler(coinflip_choice_handler, pattern='^coinflip_(high|low)$'))
-    application.add_handler(CallbackQueryHandler(coinflip_cancel_handler, pattern='^coinflip_cancel$'))
-
-    # Админ callback
-    application.add_handler(CallbackQueryHandler(admin_stats_handler, pattern='^admin_stats$'))
-    application.add_handler(CallbackQueryHandler(admin_users_handler, pattern='^admin_users$'))
-    application.add_handler(CallbackQueryHandler(admin_broadcast_menu_handler, pattern='^admin_broadcast_menu$'))
-    application.add_handler(CallbackQueryHandler(admin_broadcast_all_handler, pattern='^admin_broadcast_all$'))
-    application.add_handler(CallbackQueryHandler(admin_broadcast_one_handler, pattern='^admin_broadcast_one$'))
-    application.add_handler(
-        CallbackQueryHandler(admin_broadcast_multiple_handler, pattern='^admin_broadcast_multiple$')
-    )
-    application.add_handler(CallbackQueryHandler(admin_delete_menu_handler, pattern='^admin_delete_menu$'))
-    application.add_handler(CallbackQueryHandler(admin_give_coins_handler, pattern='^admin_give_coins$'))
-    application.add_handler(CallbackQueryHandler(admin_reports_handler, pattern='^admin_reports$'))
-    application.add_handler(CallbackQueryHandler(admin_back_handler, pattern='^admin_back$'))
-    application.add_handler(CallbackQueryHandler(cancel_report_handler, pattern='^cancel_report$'))
-
-    # Паттерны с параметрами
-    application.add_handler(CallbackQueryHandler(admin_report_detail_handler, pattern='^admin_report_\\d+$'))
-    application.add_handler(CallbackQueryHandler(admin_reply_report_handler, pattern='^admin_reply_'))
-    application.add_handler(CallbackQueryHandler(admin_approve_report_handler, pattern='^admin_approve_'))
-    application.add_handler(CallbackQueryHandler(admin_reject_report_handler, pattern='^admin_reject_'))
-    application.add_handler(CallbackQueryHandler(admin_warn_report_handler, pattern='^admin_warn_'))
-
-    # Обработчик текстовых сообщений (ПОСЛЕДНИМ!)
+    # Все callback — через одну таблицу маршрутов
+    application.add_handler(CallbackQueryHandler(dispatch_callback))
+
+    # Обработчики сообщений в режиме ожидания (ПОСЛЕДНИМИ!)
+    # Маршрутизация по флагам user_data идёт на уровне фильтров:
+    # сообщение без активного режима ожидания не попадает ни в один обработчик.
     # Расширенный фильтр: текст + медиа для рассылки
-    _broadcast_filter = filters.ALL
-    application.add_handler(MessageHandler(_broadcast_filter & ~filters.COMMAND, admin_message_handler))
+    _broadcast_filter = ~filters.COMMAND
+    _admin_filter = _broadcast_filter & filters.User(user_id=_ADMIN_IDS)
+    awaiting_handlers = [
+        (_broadcast_filter, 'awaiting_report', None, report_message_handler),
+        (_admin_filter, 'awaiting_broadcast', 'all', broadcast_all_message_handler),
+        (_admin_filter, 'awaiting_broadcast', 'one_waiting_id', broadcast_one_id_handler),
+        (_admin_filter, 'awaiting_broadcast', 'one_waiting_msg', broadcast_one_message_handler),
+        (_admin_filter, 'awaiting_broadcast', 'multiple_waiting_ids', broadcast_multiple_ids_handler),
+        (_admin_filter, 'awaiting_broadcast', 'multiple_waiting_msg', broadcast_multiple_message_handler),
+        (_admin_filter, 'awaiting_delete_user', None, delete_user_message_handler),
+        (_admin_filter, 'awaiting_give_coins', None, give_coins_message_handler),
+        (_admin_filter, 'awaiting_reply', None, reply_report_message_handler),
+        (_admin_filter, 'awaiting_warning', None, warn_report_message_handler),
+    ]
+    for base_filter, key, value, handler in awaiting_handlers:
+        application.add_handler(
+            MessageHandler(base_filter & AwaitingFilter(application, key, value), handler)
+        )
 
     # Обработчик ошибок
     application.add_error_handler(error_handler)
 
     logger.info("Бот 'Малый Шаг' запущен!")
     logger.info(f"Напоминания настроены на {config.REMINDER_TIME.strftime('%H:%M')} {config.TIMEZONE}")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Обрабатываем только сообщения и нажатия кнопок; апдейты, накопившиеся за время
+    # простоя, отбрасываем — иначе после рестарта прилетает пачка устаревших callback
+    application.run_polling(
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
+        drop_pending_updates=True
+    )
 
 
 if __name__ == '__main__':
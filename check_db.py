@@ -1,27 +1,26 @@
 # check_db.py
 import sqlite3
+from contextlib import closing
 
-conn = sqlite3.connect('habits_bot.db')
-cursor = conn.cursor()
+# closing() — контекстный менеджер самого sqlite3 только коммитит, но не закрывает
+with closing(sqlite3.connect('habits_bot.db')) as conn:
+    # Диагностика: скрипт не должен ничего писать в базу
+    conn.execute("PRAGMA query_only=1")
+    cursor = conn.cursor()
+    cursor.arraysize = 1000
 
-# Проверяем структуру таблицы
-cursor.execute("PRAGMA table_info(users)")
-columns = cursor.fetchall()
+    # Проверяем структуру таблицы
+    print("📋 Структура таблицы users:")
+    print("="*60)
+    for col in cursor.execute("PRAGMA table_info(users)"):
+        print(f"{col[1]:<20} {col[2]:<15} Default: {col[4]}")
+    print("="*60)
 
-print("📋 Структура таблицы users:")
-print("="*60)
-for col in columns:
-    print(f"{col[1]:<20} {col[2]:<15} Default: {col[4]}")
-print("="*60)
-
-# Проверяем данные пользователей
-cursor.execute("SELECT user_id, username, coins, achievements FROM users")
-users = cursor.fetchall()
-
-print("\n👥 Пользователи:")
-print("="*60)
-for user in users:
-    print(f"ID: {user[0]}, Name: {user[1]}, Coins: {user[2]}, Achievements: {user[3]}")
-print("="*60)
-
-conn.close()
+    # Проверяем данные пользователей (построчно, без загрузки всей таблицы в память)
+    print("\n👥 Пользователи:")
+    print("="*60)
+    for user_id, username, coins, achievements in cursor.execute(
+        "SELECT user_id, username, coins, achievements FROM users"
+    ):
+        print(f"ID: {user_id}, Name: {username}, Coins: {coins}, Achievements: {achievements}")
+    print("="*60)
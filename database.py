@@ -1,15 +1,66 @@
 import os
+import re
 import json
+import time
+import threading
 import pytz
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
-from typing import Optional, Dict, Any, List
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from typing import Optional, Dict, Any, Iterator
 import config
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:  # orjson не установлен — stdlib json, поведение то же
+    _json_loads = json.loads
+
 MINSK_TZ = pytz.timezone('Europe/Minsk')
 
+# Кэш текущей даты: (monotonic-время истечения, дата)
+_today_cache: tuple[float, date] = (float('-inf'), date.min)
+
+
 def _today_minsk() -> date:
-    """Текущая дата по минскому времени (UTC+3)."""
-    return datetime.now(MINSK_TZ).date()
+    """Текущая дата по минскому времени (UTC+3). Пересчитывается не чаще раза в минуту."""
+    global _today_cache
+    now = time.monotonic()
+    if now < _today_cache[0]:
+        return _today_cache[1]
+    dt = datetime.now(MINSK_TZ)
+    # Не держим кэш дольше полуночи — иначе задачи в 00:00 увидят вчерашнюю дату
+    until_midnight = 86400 - (dt.hour * 3600 + dt.minute * 60 + dt.second + dt.microsecond / 1e6)
+    _today_cache = (now + min(60, until_midnight), dt.date())
+    return _today_cache[1]
+
+
+@lru_cache(maxsize=4)
+def _minsk_day_utc_bounds(day: date) -> tuple[str, str]:
+    """
+    Границы минских суток в UTC ('YYYY-MM-DD HH:MM:SS') — в этом виде
+    CURRENT_TIMESTAMP пишет created_at, так что сравнение идёт по индексу.
+    """
+    start = MINSK_TZ.localize(datetime.combine(day, datetime.min.time())).astimezone(pytz.utc)
+    end = start + timedelta(days=1)
+    fmt = '%Y-%m-%d %H:%M:%S'
+    return start.strftime(fmt), end.strftime(fmt)
+
+
+@lru_cache(maxsize=1024)
+def _parse_date(value: str) -> date:
+    """date.fromisoformat с кэшем — одни и те же даты разбираются на каждом рендере."""
+    return date.fromisoformat(value)
+
+
+def _decode_json_set(value: Optional[str]) -> frozenset:
+    """
+    JSON-список из колонки users в frozenset: проверка "есть ли" за O(1),
+    а неизменяемость позволяет делить его между копиями строки из кэша.
+    """
+    return frozenset(_json_loads(value)) if value else frozenset()
 
 
 # Определяем тип БД
@@ -17,11 +68,136 @@ USE_POSTGRES = os.getenv('DATABASE_URL') is not None
 
 if USE_POSTGRES:
     import psycopg2
-    from psycopg2.extras import Json
+    from psycopg2 import pool
+    from psycopg2.extras import execute_batch
+
+    class _PreparedConnection(psycopg2.extensions.connection):
+        """Соединение, которое помнит, какие запросы на нём уже подготовлены (PREPARE)"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
 else:
     import sqlite3
 
 
+# Колонки users, которые добавляются миграцией в _create_schema
+ADDED_USER_COLUMNS = (
+    'current_challenge', 'current_category', 'streak_freeze_until', 'double_coins_until',
+    'challenge_date', 'lastcoinflipdate',
+)
+
+# Колонки, которые отдаёт get_user — известны заранее, cursor.description не нужен
+USER_COLUMNS = (
+    'user_id', 'username', 'first_name', 'language_code', 'streak', 'longest_streak',
+    'total_completed', 'coins', 'warnings', 'last_completed_date', 'purchased_items',
+    'achievements', 'current_challenge', 'current_category', 'challenge_date',
+    'streak_freeze_until', 'double_coins_until', 'lastcoinflipdate',
+)
+# Колонки getpendingreports
+PENDING_REPORT_COLUMNS = ('id', 'user_id', 'username', 'message', 'created_at')
+
+# Горячие запросы: на Postgres парсятся и планируются один раз на соединение.
+# Параметры — $1, $2, ... (для SQLite они превращаются в ?1, ?2, ...).
+PREPARED_QUERIES = {
+    # Явный список колонок: без created_at (на Postgres это ещё и лишний datetime на строку)
+    'get_user': f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id = $1",
+    'get_report': 'SELECT user_id, username, message, created_at FROM reports WHERE id = $1',
+    'add_report': 'INSERT INTO reports (user_id, username, message) VALUES ($1, $2, $3)',
+    'update_report_status': 'UPDATE reports SET status = $1, admin_response = $2 WHERE id = $3',
+    'add_coins': 'UPDATE users SET coins = coins + $1 WHERE user_id = $2',
+    'count_user_reports_today': (
+        # Диапазон по created_at, а не DATE(created_at): работает индекс idx_reports_user
+        'SELECT COUNT(*) FROM reports WHERE user_id = $1 AND created_at >= $2 AND created_at < $3'
+    ),
+    'get_category_stats': (
+        'SELECT category, COUNT(*) FROM history WHERE user_id = $1 GROUP BY category'
+    ),
+    'get_last_report_time': (
+        'SELECT created_at FROM reports WHERE user_id = $1 ORDER BY created_at DESC LIMIT 1'
+    ),
+    # ON CONFLICT ... DO NOTHING понимают и Postgres, и SQLite (>= 3.24)
+    'add_user': (
+        'INSERT INTO users (user_id, username, first_name, language_code) '
+        'VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO NOTHING'
+    ),
+    'update_challenge': (
+        'UPDATE users SET current_challenge = $1, current_category = $2, challenge_date = $3 '
+        'WHERE user_id = $4'
+    ),
+}
+
+# complete_challenge: $1 — вчера, $2 — сегодня (ISO), $3 — user_id.
+# Даты хранятся в ISO-формате, поэтому их можно сравнивать как строки.
+# Вчера выполнял — стрик растёт; пропустил, но активна заморозка — сохраняется;
+# иначе (или первый раз) — начинается заново
+_NEW_STREAK_SQL = '''CASE
+            WHEN last_completed_date = $1 THEN streak + 1
+            WHEN last_completed_date IS NOT NULL AND streak_freeze_until >= $2 THEN streak
+            ELSE 1
+        END'''
+# Активен x2 бонус — 10 монет, иначе 5
+_COINS_EARNED_SQL = 'CASE WHEN double_coins_until >= $2 THEN 10 ELSE 5 END'
+PREPARED_QUERIES['complete_challenge'] = f'''
+    UPDATE users
+    SET streak = {_NEW_STREAK_SQL},
+        longest_streak = CASE
+            WHEN {_NEW_STREAK_SQL} > longest_streak THEN {_NEW_STREAK_SQL}
+            ELSE longest_streak
+        END,
+        total_completed = total_completed + 1,
+        coins = coins + {_COINS_EARNED_SQL},
+        last_completed_date = $2
+    WHERE user_id = $3
+      AND (last_completed_date IS NULL OR last_completed_date <> $2)
+    RETURNING streak, total_completed, coins, {_COINS_EARNED_SQL} AS coins_earned,
+              current_category, current_challenge
+'''
+# На Postgres запись в историю — в том же запросе (data-modifying CTE): один round-trip
+PREPARED_QUERIES['complete_challenge_with_history'] = f'''
+    WITH upd AS ({PREPARED_QUERIES['complete_challenge']}),
+    ins AS (
+        INSERT INTO history (user_id, category, challenge)
+        SELECT $3, current_category, current_challenge FROM upd
+    )
+    SELECT streak, total_completed, coins, coins_earned, current_category, current_challenge
+    FROM upd
+'''
+
+# SQLite понимает нумерованные ?NNN, поэтому один параметр можно использовать несколько раз
+_SQLITE_QUERIES = {name: re.sub(r'\$(\d+)', r'?\1', sql) for name, sql in PREPARED_QUERIES.items()}
+# Кэш скомпилированных выражений у sqlite3 — на соединение; по умолчанию 128,
+# берём с запасом, чтобы редкие запросы (админка, схема) не вытесняли горячие
+SQLITE_CACHED_STATEMENTS = 512
+
+# Пул соединений Postgres: минимум держим открытым, максимум — с запасом под
+# concurrent_updates бота и потоки asyncio.to_thread
+PG_POOL_MINCONN = 2
+PG_POOL_MAXCONN = 20
+
+# Кэш get_user: переходы по меню (профиль → топ → профиль) не ходят в БД каждый раз
+USER_CACHE_TTL = 30  # секунд; ограничивает устаревание при записи в БД в обход Database
+USER_CACHE_MAXSIZE = 10_000
+# Топ-10 не обязан быть живым до секунды; complete_challenge, reset_streak(s_bulk)
+# и delete_user_data (меняют стрики/выполненные) сбрасывают его сразу
+LEADERBOARD_CACHE_TTL = 30
+
+# Отрицательный кэш: "такого пользователя нет" помним недолго (add_user его и так сбрасывает)
+USER_CACHE_MISS_TTL = 10
+
+
+def _invalidates_user(method):
+    """Метод пишет в строку users с user_id из первого аргумента — сбрасываем её кэш"""
+    @wraps(method)
+    def wrapper(self, user_id, *args, **kwargs):
+        self._forget_user(user_id)
+        try:
+            return method(self, user_id, *args, **kwargs)
+        finally:
+            self._forget_user(user_id)
+    return wrapper
+
+
 class Database:
     def __init__(self):
         self.use_postgres = USE_POSTGRES
@@ -29,24 +205,118 @@ class Database:
             self.db_url = os.getenv('DATABASE_URL')
             if self.db_url.startswith('postgres://'):
                 self.db_url = self.db_url.replace('postgres://', 'postgresql://', 1)
+            # PREPARE живёт в рамках сессии, поэтому соединения переиспользуются
+            self._pool = pool.ThreadedConnectionPool(
+                PG_POOL_MINCONN, PG_POOL_MAXCONN, self.db_url,
+                connection_factory=_PreparedConnection
+            )
+            # ThreadedConnectionPool при исчерпании сразу бросает PoolError —
+            # лишние потоки вместо этого ждут свободное соединение
+            self._pool_slots = threading.BoundedSemaphore(PG_POOL_MAXCONN)
         else:
             self.db_name = config.DATABASE_NAME
+            # Своё постоянное соединение на каждый поток (event loop + потоки
+            # asyncio.to_thread): в WAL читатели не ждут писателя, а соединение
+            # и PRAGMA не пересоздаются на каждый запрос
+            self._sqlite_local = threading.local()
+        # user_id -> (monotonic-время истечения, строка или None); порядок — LRU
+        self._user_cache: OrderedDict[int, tuple[float, Optional[Dict[str, Any]]]] = OrderedDict()
+        self._user_cache_lock = threading.Lock()
+        # user_id -> (monotonic-время истечения, выполненные по категориям) для get_stats;
+        # история пишется только методами с @_invalidates_user, так что сбрасывается вместе
+        self._stats_cache: OrderedDict[int, tuple[float, Dict[str, int]]] = OrderedDict()
+        # (monotonic-время истечения, строки топа) и счётчик сбросов — как у кэша get_user
+        self._leaderboard_cache: tuple[float, list] = (float('-inf'), [])
+        self._leaderboard_gen = 0
+        # Растёт при каждой инвалидации: чтение, начатое до записи, не кладёт старую строку в кэш
+        self._user_cache_gen = 0
         self.init_db()
 
+    def _configure_sqlite(self, conn):
+        """PRAGMA для SQLite: WAL (читатели не ждут писателя), меньше fsync, кэш и mmap"""
+        if self.db_name != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-64000')  # ~64 МБ
+        conn.execute('PRAGMA mmap_size=268435456')  # 256 МБ
+        conn.execute('PRAGMA busy_timeout=5000')
+
+    def _forget_user(self, user_id: Optional[int] = None):
+        """Сбросить кэш get_user и get_stats для одного пользователя (или для всех)"""
+        with self._user_cache_lock:
+            self._user_cache_gen += 1
+            if user_id is None:
+                self._user_cache.clear()
+                self._stats_cache.clear()
+            else:
+                self._user_cache.pop(user_id, None)
+                self._stats_cache.pop(user_id, None)
+
+    def _forget_leaderboard(self):
+        """Сбросить кэш get_leaderboard (после записей, меняющих стрики или выполненные)"""
+        with self._user_cache_lock:
+            self._leaderboard_gen += 1
+            self._leaderboard_cache = (float('-inf'), [])
+
+    @contextmanager
     def get_connection(self):
-        """Получить подключение к БД"""
+        """Получить подключение к БД (Postgres — из пула, SQLite — постоянное для потока)"""
         if self.use_postgres:
-            return psycopg2.connect(self.db_url)
+            self._pool_slots.acquire()
+            try:
+                conn = self._pool.getconn()
+                try:
+                    yield conn
+                finally:
+                    # Незакоммиченная транзакция не должна уехать в пул вместе с соединением
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        conn.close()
+                    self._pool.putconn(conn, close=bool(conn.closed))
+            finally:
+                self._pool_slots.release()
         else:
-            conn = sqlite3.connect(self.db_name)
-            conn.row_factory = sqlite3.Row
-            return conn
+            local = self._sqlite_local
+            conn = getattr(local, 'conn', None)
+            if conn is None:
+                conn = sqlite3.connect(
+                    self.db_name, check_same_thread=False,
+                    cached_statements=SQLITE_CACHED_STATEMENTS
+                )
+                conn.row_factory = sqlite3.Row
+                self._configure_sqlite(conn)
+                local.conn = conn
+                local.depth = 0
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+                # Как и с пулом: брошенная на полпути транзакция не переживает вызов
+                if local.depth == 0 and conn.in_transaction:
+                    conn.rollback()
+
+    def _execute_prepared(self, conn, cursor, name: str, params: tuple):
+        """Выполнить запрос из PREPARED_QUERIES, подготовив его при первом использовании"""
+        if not self.use_postgres:
+            cursor.execute(_SQLITE_QUERIES[name], params)
+            return
+        if name not in conn.prepared:
+            cursor.execute(f'PREPARE {name} AS {PREPARED_QUERIES[name]}')
+            conn.prepared.add(name)
+        placeholders = ', '.join(['%s'] * len(params))
+        cursor.execute(f'EXECUTE {name} ({placeholders})', params)
 
     def init_db(self):
         """Инициализация базы данных"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.get_connection() as conn:
+            self._create_schema(conn.cursor())
+            conn.commit()
 
+    def _create_schema(self, cursor):
+        """Создание таблиц и недостающих колонок"""
         if self.use_postgres:
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -132,71 +402,118 @@ class Database:
                 )
             ''')
 
-        # Добавляем колонки если их нет
-        try:
-            if self.use_postgres:
-                cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS current_challenge TEXT")
-                cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS current_category TEXT")
-                cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS streak_freeze_until TEXT")
-                cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS double_coins_until TEXT")
-                cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS challenge_date TEXT")
-                cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS lastcoinflipdate TEXT")
-            else:
-                cursor.execute("PRAGMA table_info(users)")
-                columns = [col[1] for col in cursor.fetchall()]
-                if 'current_challenge' not in columns:
-                    cursor.execute('ALTER TABLE users ADD COLUMN current_challenge TEXT')
-                if 'current_category' not in columns:
-                    cursor.execute('ALTER TABLE users ADD COLUMN current_category TEXT')
-                if 'streak_freeze_until' not in columns:
-                    cursor.execute('ALTER TABLE users ADD COLUMN streak_freeze_until TEXT')
-                if 'double_coins_until' not in columns:
-                    cursor.execute('ALTER TABLE users ADD COLUMN double_coins_until TEXT')
-                if 'lastcoinflipdate' not in columns:
-                    cursor.execute('ALTER TABLE users ADD COLUMN lastcoinflipdate TEXT')
-        except Exception as e:
-            pass
-
-        conn.commit()
-        conn.close()
+        # Партии коинфлипа: ставка списывается при старте, итог фиксируется отдельно
+        if self.use_postgres:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS coinflip_games (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT,
+                    bet INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    resolved INTEGER DEFAULT 0,
+                    won INTEGER,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            ''')
+        else:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS coinflip_games (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    bet INTEGER,
+                    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                    resolved INTEGER DEFAULT 0,
+                    won INTEGER,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            ''')
+
+        # Индекс под подсчёт выполненных по категориям (GROUP BY в get_stats)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_history_user_category
+            ON history (user_id, category)
+        ''')
 
+        # Индексы под жалобы: частичный — под список ожидающих для админа,
+        # составной — под последнюю жалобу / жалобы за сегодня у пользователя
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_reports_pending
+            ON reports (created_at DESC) WHERE status = 'pending'
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_reports_user
+            ON reports (user_id, created_at DESC)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_users_last_date
+            ON users (last_completed_date)
+        ''')
+
+        # Индекс под топ игроков: ORDER BY ... LIMIT отвечается обходом индекса
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_users_streak
+            ON users (streak DESC, total_completed DESC, user_id)
+        ''')
+        cursor.execute('ANALYZE users')
+        cursor.execute('ANALYZE reports')
+
+        # Добавляем колонки если их нет (все — TEXT, появились после первой версии схемы)
+        if self.use_postgres:
+            for column in ADDED_USER_COLUMNS:
+                cursor.execute(f'ALTER TABLE users ADD COLUMN IF NOT EXISTS {column} TEXT')
+        else:
+            cursor.execute("PRAGMA table_info(users)")
+            existing = {col[1] for col in cursor.fetchall()}
+            for column in ADDED_USER_COLUMNS:
+                if column not in existing:
+                    cursor.execute(f'ALTER TABLE users ADD COLUMN {column} TEXT')
+
+    @_invalidates_user
     def add_user(self, user_id: int, username: str, first_name: str, language_code: str = 'ru'):
         """Добавить пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            if self.use_postgres:
-                cursor.execute('''
-                    INSERT INTO users (user_id, username, first_name, language_code)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (user_id) DO NOTHING
-                ''', (user_id, username, first_name, language_code))
-            else:
-                cursor.execute('''
-                    INSERT OR IGNORE INTO users (user_id, username, first_name, language_code)
-                    VALUES (?, ?, ?, ?)
-                ''', (user_id, username, first_name, language_code))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(
+                conn, cursor, 'add_user', (user_id, username, first_name, language_code)
+            )
             conn.commit()
-        finally:
-            conn.close()
 
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Получить данные пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'SELECT * FROM users WHERE user_id = {param}', (user_id,))
+        """
+        Получить данные пользователя (с кэшем на USER_CACHE_TTL секунд).
+        achievements и purchased_items уже разобраны — это frozenset id.
+        """
+        now = time.monotonic()
+        with self._user_cache_lock:
+            cached = self._user_cache.get(user_id)
+            if cached is not None and cached[0] > now:
+                self._user_cache.move_to_end(user_id)
+                return dict(cached[1]) if cached[1] is not None else None
+            gen = self._user_cache_gen
+
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(conn, cursor, 'get_user', (user_id,))
             row = cursor.fetchone()
-            if row:
-                if self.use_postgres:
-                    columns = [desc[0] for desc in cursor.description]
-                    return dict(zip(columns, row))
-                else:
-                    return dict(row)
+        if not row:
+            self._cache_user(user_id, None, now + USER_CACHE_MISS_TTL, gen)
             return None
-        finally:
-            conn.close()
+        user = dict(zip(USER_COLUMNS, row))
+        # JSON-колонки разбираем один раз при попадании в кэш, а не на каждом рендере
+        user['achievements'] = _decode_json_set(user['achievements'])
+        user['purchased_items'] = _decode_json_set(user['purchased_items'])
+
+        self._cache_user(user_id, user, now + USER_CACHE_TTL, gen)
+        return dict(user)
+
+    def _cache_user(self, user_id: int, user: Optional[Dict[str, Any]], expires: float, gen: int):
+        """Положить строку (или None — "нет такого") в кэш, если с начала чтения не было записей"""
+        with self._user_cache_lock:
+            if gen == self._user_cache_gen:
+                self._user_cache[user_id] = (expires, user)
+                self._user_cache.move_to_end(user_id)
+                if len(self._user_cache) > USER_CACHE_MAXSIZE:
+                    self._user_cache.popitem(last=False)
 
     def get_stats(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получить статистику пользователя"""
@@ -204,583 +521,717 @@ class Database:
         if not user:
             return None
 
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        category_stats = self._get_category_stats(user_id)
+        stats = {
+            'user_id': user['user_id'],
+            'username': user['username'],
+            'streak': user['streak'],
+            'longest_streak': user['longest_streak'],
+            'total_completed': user['total_completed'],
+            'coins': user['coins'],
+            'last_completed_date': user['last_completed_date'],
+            'achievements': user['achievements'],
+            'category_stats': category_stats
+        }
+        return stats
+
+    def _get_category_stats(self, user_id: int) -> Dict[str, int]:
+        """Выполненные челленджи по категориям (с кэшем на USER_CACHE_TTL секунд)"""
+        now = time.monotonic()
+        with self._user_cache_lock:
+            cached = self._stats_cache.get(user_id)
+            if cached is not None and cached[0] > now:
+                self._stats_cache.move_to_end(user_id)
+                return dict(cached[1])
+            gen = self._user_cache_gen
+
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(conn, cursor, 'get_category_stats', (user_id,))
+            category_stats = dict(cursor.fetchall())
+
+        with self._user_cache_lock:
+            if gen == self._user_cache_gen:
+                self._stats_cache[user_id] = (now + USER_CACHE_TTL, category_stats)
+                self._stats_cache.move_to_end(user_id)
+                if len(self._stats_cache) > USER_CACHE_MAXSIZE:
+                    self._stats_cache.popitem(last=False)
+        return dict(category_stats)
+
+    @_invalidates_user
+    def reset_streak(self, user_id: int):
+        """Сбросить streak"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
             param = '%s' if self.use_postgres else '?'
             cursor.execute(f'''
-                SELECT category, COUNT(*) as count
-                FROM history
-                WHERE user_id = {param}
-                GROUP BY category
-            ''', (user_id,))
-            category_stats = {}
-            for row in cursor.fetchall():
-                category_stats[row[0]] = row[1]
-
-            cursor.execute(f'''
-                SELECT category, challenge, completed_at
-                FROM history
-                WHERE user_id = {param}
-                ORDER BY completed_at DESC
+                UPDATE users SET streak = 0 WHERE user_id = {param}
             ''', (user_id,))
-            history = []
-            for row in cursor.fetchall():
-                history.append({
-                    'category': row[0],
-                    'challenge': row[1],
-                    'completed_at': row[2]
-                })
-
-            stats = {
-                'user_id': user['user_id'],
-                'username': user['username'],
-                'streak': user['streak'],
-                'longest_streak': user['longest_streak'],
-                'total_completed': user['total_completed'],
-                'coins': user['coins'],
-                'last_completed_date': user['last_completed_date'],
-                'achievements': json.loads(user['achievements']) if user['achievements'] else [],
-                'category_stats': category_stats,
-                'history': history
-            }
-            return stats
-        finally:
-            conn.close()
+            conn.commit()
+        self._forget_leaderboard()
 
-    def update_streak(self, user_id: int):
-        """Обновить streak"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            today = _today_minsk().isoformat()
+    def _executemany(self, cursor, sql: str, rows: list):
+        """Пакетное выполнение одного запроса (на Postgres — пачками за один round-trip)"""
+        if self.use_postgres:
+            execute_batch(cursor, sql, rows)
+        else:
+            cursor.executemany(sql, rows)
+
+    def reset_streaks_bulk(self, user_ids: list):
+        """Сбросить streak сразу у многих пользователей одной транзакцией"""
+        if not user_ids:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
             param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'''
-                UPDATE users
-                SET streak = streak + 1,
-                    longest_streak = GREATEST(longest_streak, streak + 1),
-                    total_completed = total_completed + 1,
-                    last_completed_date = {param}
-                WHERE user_id = {param}
-            ''', (today, user_id))
+            self._executemany(
+                cursor, f'UPDATE users SET streak = 0 WHERE user_id = {param}',
+                [(user_id,) for user_id in user_ids]
+            )
             conn.commit()
-        finally:
-            conn.close()
-
-    def reset_streak(self, user_id: int):
-        """Сбросить streak"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        for user_id in user_ids:
+            self._forget_user(user_id)
+        self._forget_leaderboard()
+
+    def add_coins_bulk(self, pairs: list):
+        """Начислить монеты многим пользователям одной транзакцией: [(user_id, amount), ...]"""
+        if not pairs:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
             param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'''
-                UPDATE users SET streak = 0 WHERE user_id = {param}
-            ''', (user_id,))
+            self._executemany(
+                cursor, f'UPDATE users SET coins = coins + {param} WHERE user_id = {param}',
+                [(amount, user_id) for user_id, amount in pairs]
+            )
             conn.commit()
-        finally:
-            conn.close()
+        for user_id, _ in pairs:
+            self._forget_user(user_id)
 
+    @_invalidates_user
     def add_coins(self, user_id: int, amount: int):
         """Добавить монеты"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'''
-                UPDATE users SET coins = coins + {param} WHERE user_id = {param}
-            ''', (amount, user_id))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(conn, cursor, 'add_coins', (amount, user_id))
             conn.commit()
-        finally:
-            conn.close()
 
     def get_coins(self, user_id: int) -> int:
         """Получить количество монет"""
         user = self.get_user(user_id)
         return user['coins'] if user else 0
 
+    @_invalidates_user
     def purchase_item(self, user_id: int, item_id: str, cost: int) -> bool:
-        """Купить предмет"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'SELECT coins, purchased_items FROM users WHERE user_id = {param}', (user_id,))
-            row = cursor.fetchone()
-            if not row:
-                return False
-            coins = row[0]
-            purchased_items = json.loads(row[1]) if row[1] else []
-            if coins < cost or item_id in purchased_items:
-                return False
-            purchased_items.append(item_id)
-            new_coins = coins - cost
-            cursor.execute(f'''
-                UPDATE users SET coins = {param}, purchased_items = {param} WHERE user_id = {param}
-            ''', (new_coins, json.dumps(purchased_items), user_id))
+        """
+        Купить предмет.
+        Хватает ли монет и нет ли уже предмета — проверяется в том же UPDATE,
+        который списывает монеты и дописывает предмет в JSON-массив.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                cursor.execute('''
+                    UPDATE users
+                    SET coins = coins - %s,
+                        purchased_items = (
+                            COALESCE(NULLIF(purchased_items, ''), '[]')::jsonb || to_jsonb(%s::text)
+                        )::text
+                    WHERE user_id = %s
+                      AND coins >= %s
+                      AND NOT COALESCE(NULLIF(purchased_items, ''), '[]')::jsonb ? %s
+                ''', (cost, item_id, user_id, cost, item_id))
+            else:
+                cursor.execute('''
+                    UPDATE users
+                    SET coins = coins - ?,
+                        purchased_items = json_insert(COALESCE(NULLIF(purchased_items, ''), '[]'), '$[#]', ?)
+                    WHERE user_id = ?
+                      AND coins >= ?
+                      AND NOT EXISTS (
+                          SELECT 1 FROM json_each(COALESCE(NULLIF(purchased_items, ''), '[]'))
+                          WHERE value = ?
+                      )
+                ''', (cost, item_id, user_id, cost, item_id))
             conn.commit()
-            return True
-        finally:
-            conn.close()
+            return cursor.rowcount == 1
 
     def get_purchased_items(self, user_id: int) -> list:
         """Получить купленные предметы"""
         user = self.get_user(user_id)
-        if user and user['purchased_items']:
-            return json.loads(user['purchased_items'])
-        return []
+        return list(user['purchased_items']) if user else []
 
+    @_invalidates_user
     def add_achievement(self, user_id: int, achievement_id: str) -> bool:
-        """Добавить достижение"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'SELECT achievements FROM users WHERE user_id = {param}', (user_id,))
-            row = cursor.fetchone()
-            if row:
-                achievements = json.loads(row[0]) if row[0] else []
-                if achievement_id in achievements:
-                    return False
-                achievements.append(achievement_id)
-                cursor.execute(f'''
-                    UPDATE users SET achievements = {param} WHERE user_id = {param}
-                ''', (json.dumps(achievements), user_id))
-                conn.commit()
-                return True
-            return False
-        finally:
-            conn.close()
+        """Добавить достижение (без награды)"""
+        return self.grant_reward(user_id, achievement_id=achievement_id)
+
+    @_invalidates_user
+    def grant_reward(self, user_id: int, coins: int = 0, achievement_id: str = None) -> bool:
+        """
+        Выдать награду одним UPDATE: монеты и (если указано) достижение.
+        Проверка "достижение уже есть" и дописывание в JSON-массив делаются на стороне БД,
+        поэтому повторный (или параллельный) вызов ничего не меняет и вернёт False —
+        монеты за одно достижение дважды не начислятся.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if achievement_id is None:
+                self._execute_prepared(conn, cursor, 'add_coins', (coins, user_id))
+            elif self.use_postgres:
+                cursor.execute('''
+                    UPDATE users
+                    SET achievements = (
+                            COALESCE(NULLIF(achievements, ''), '[]')::jsonb || to_jsonb(%s::text)
+                        )::text,
+                        coins = coins + %s
+                    WHERE user_id = %s
+                      AND NOT COALESCE(NULLIF(achievements, ''), '[]')::jsonb ? %s
+                ''', (achievement_id, coins, user_id, achievement_id))
+            else:
+                cursor.execute('''
+                    UPDATE users
+                    SET achievements = json_insert(COALESCE(NULLIF(achievements, ''), '[]'), '$[#]', ?),
+                        coins = coins + ?
+                    WHERE user_id = ?
+                      AND NOT EXISTS (
+                          SELECT 1 FROM json_each(COALESCE(NULLIF(achievements, ''), '[]'))
+                          WHERE value = ?
+                      )
+                ''', (achievement_id, coins, user_id, achievement_id))
+            conn.commit()
+            return cursor.rowcount == 1
 
     def get_achievements(self, user_id: int) -> list:
         """Получить достижения"""
         user = self.get_user(user_id)
-        if user and user['achievements']:
-            return json.loads(user['achievements'])
-        return []
+        return list(user['achievements']) if user else []
 
     def get_leaderboard(self):
-        """Топ-10 пользователей по стрику и по выполненным"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT first_name, username, streak, total_completed, coins
-            FROM users
-            ORDER BY streak DESC, total_completed DESC
-            LIMIT 10
-        ''')
-        rows = cursor.fetchall()
-        conn.close()
+        """Топ-10 пользователей с ненулевым стриком (по стрику и по выполненным), с кэшем"""
+        now = time.monotonic()
+        with self._user_cache_lock:
+            expires, cached = self._leaderboard_cache
+            if expires > now:
+                return [dict(row) for row in cached]
+            gen = self._leaderboard_gen
+
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user_id, first_name, username, streak, total_completed, coins
+                FROM users
+                WHERE streak > 0
+                ORDER BY streak DESC, total_completed DESC
+                LIMIT 10
+            ''')
+            rows = cursor.fetchall()
 
-        return [
+        leaderboard = [
             {
-                'first_name': row[0],
-                'username': row[1],
-                'streak': row[2],
-                'total_completed': row[3],
-                'coins': row[4],
+                'user_id': row[0],
+                'first_name': row[1],
+                'username': row[2],
+                'streak': row[3],
+                'total_completed': row[4],
+                'coins': row[5],
             }
             for row in rows
         ]
+        with self._user_cache_lock:
+            if gen == self._leaderboard_gen:
+                self._leaderboard_cache = (now + LEADERBOARD_CACHE_TTL, leaderboard)
+        return [dict(row) for row in leaderboard]
+
+    def get_admin_stats(self) -> Dict[str, Any]:
+        """Сводка для админ-панели одним запросом (жалобы за сегодня — по минскому времени)"""
+        today = _today_minsk()
+        start, end = _minsk_day_utc_bounds(today)
+        param = '%s' if self.use_postgres else '?'
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT
+                    (SELECT COUNT(*) FROM users),
+                    (SELECT COUNT(*) FROM users WHERE last_completed_date = {param}),
+                    (SELECT SUM(total_completed) FROM users),
+                    (SELECT AVG(streak) FROM users),
+                    (SELECT COUNT(*) FROM reports WHERE status = 'pending'),
+                    (SELECT COUNT(*) FROM reports WHERE created_at >= {param} AND created_at < {param}),
+                    (SELECT COUNT(*) FROM users WHERE warnings >= 3)
+            ''', (today.isoformat(), start, end))
+            row = cursor.fetchone()
+        return {
+            'total_users': row[0] or 0,
+            'active_today': row[1] or 0,
+            'total_challenges': row[2] or 0,
+            'avg_streak': float(row[3] or 0),
+            'pending_reports': row[4] or 0,
+            'reports_today': row[5] or 0,
+            'banned_users': row[6] or 0,
+        }
+
+    def get_top_users(self, limit: int = 15) -> list:
+        """Топ пользователей по выполненным челленджам для админки"""
+        param = '%s' if self.use_postgres else '?'
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT user_id, username, total_completed, streak, coins, warnings
+                FROM users
+                ORDER BY total_completed DESC
+                LIMIT {param}
+            ''', (limit,))
+            return cursor.fetchall()
 
     def add_report(self, user_id: int, username: str, message: str):
         """Добавить жалобу"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            if self.use_postgres:
-                cursor.execute('''
-                    INSERT INTO reports (user_id, username, message) VALUES (%s, %s, %s)
-                ''', (user_id, username, message))
-            else:
-                cursor.execute('''
-                    INSERT INTO reports (user_id, username, message) VALUES (?, ?, ?)
-                ''', (user_id, username, message))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(conn, cursor, 'add_report', (user_id, username, message))
             conn.commit()
-        finally:
-            conn.close()
 
     def getpendingreports(self) -> list:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT * FROM reports WHERE status = 'pending' ORDER BY created_at DESC")
-            rows = cursor.fetchall()
-            if self.use_postgres:
-                columns = [desc[0] for desc in cursor.description]
-                return [dict(zip(columns, row)) for row in rows]
-            else:
-                return [dict(row) for row in rows]
-        finally:
-            conn.close()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT {', '.join(PENDING_REPORT_COLUMNS)} FROM reports "
+                "WHERE status = 'pending' ORDER BY created_at DESC"
+            )
+            return [dict(zip(PENDING_REPORT_COLUMNS, row)) for row in cursor.fetchall()]
+
+    def get_report(self, report_id: int):
+        """Получить жалобу: (user_id, username, message, created_at)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(conn, cursor, 'get_report', (report_id,))
+            return cursor.fetchone()
 
     def update_report_status(self, report_id: int, status: str, admin_response: str = None):
         """Обновить статус жалобы"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'''
-                UPDATE reports SET status = {param}, admin_response = {param} WHERE id = {param}
-            ''', (status, admin_response, report_id))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(
+                conn, cursor, 'update_report_status', (status, admin_response, report_id)
+            )
             conn.commit()
-        finally:
-            conn.close()
 
+    @_invalidates_user
     def add_warning(self, user_id: int):
         """Добавить предупреждение"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
             param = '%s' if self.use_postgres else '?'
             cursor.execute(f'''
                 UPDATE users SET warnings = warnings + 1 WHERE user_id = {param}
             ''', (user_id,))
             conn.commit()
-        finally:
-            conn.close()
 
+    @_invalidates_user
+    def warn_and_close_report(self, user_id: int, report_id: int, admin_response: str):
+        """Выдать предупреждение и закрыть жалобу одной транзакцией"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                cursor.execute('''
+                    WITH warned AS (
+                        UPDATE users SET warnings = warnings + 1 WHERE user_id = %s
+                    )
+                    UPDATE reports SET status = 'warned', admin_response = %s WHERE id = %s
+                ''', (user_id, admin_response, report_id))
+            else:
+                cursor.execute(
+                    'UPDATE users SET warnings = warnings + 1 WHERE user_id = ?', (user_id,)
+                )
+                cursor.execute(
+                    "UPDATE reports SET status = 'warned', admin_response = ? WHERE id = ?",
+                    (admin_response, report_id)
+                )
+            conn.commit()
+
+    @_invalidates_user
     def delete_user_data(self, user_id: int):
         """Удалить данные пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'DELETE FROM history WHERE user_id = {param}', (user_id,))
-            cursor.execute(f'DELETE FROM reports WHERE user_id = {param}', (user_id,))
-            cursor.execute(f'DELETE FROM users WHERE user_id = {param}', (user_id,))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                # Один запрос вместо четырёх round-trip'ов; FK (NO ACTION) проверяются
+                # в конце запроса, когда зависимые строки уже удалены
+                cursor.execute('''
+                    WITH h AS (DELETE FROM history WHERE user_id = %(uid)s),
+                         r AS (DELETE FROM reports WHERE user_id = %(uid)s),
+                         c AS (DELETE FROM coinflip_games WHERE user_id = %(uid)s)
+                    DELETE FROM users WHERE user_id = %(uid)s
+                ''', {'uid': user_id})
+            else:
+                cursor.execute('DELETE FROM history WHERE user_id = ?', (user_id,))
+                cursor.execute('DELETE FROM reports WHERE user_id = ?', (user_id,))
+                cursor.execute('DELETE FROM coinflip_games WHERE user_id = ?', (user_id,))
+                cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
             conn.commit()
-        finally:
-            conn.close()
+        self._forget_leaderboard()
 
     def get_all_users(self) -> list:
         """Получить всех пользователей"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute('SELECT user_id FROM users')
-            return [row[0] for row in cursor.fetchall()]
-        finally:
-            conn.close()
+        return list(self.iter_all_users())
+
+    def iter_all_users(self, batch_size: int = 1000) -> Iterator[int]:
+        """Перебрать user_id всех пользователей пачками по batch_size"""
+        for user in self.iter_all_users_full(('user_id',), batch_size):
+            yield user['user_id']
+
+    def iter_all_users_full(self, columns: tuple = ('user_id',),
+                            batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """
+        Перебрать всех пользователей пачками по batch_size: словари с нужными колонками
+        (одним запросом на пачку вместо get_user на каждого — для рассылок и ночных задач).
+        Каждая пачка — отдельный короткий запрос по первичному ключу, так что между
+        пачками соединение не удерживается и цикл можно прерывать await'ами.
+        """
+        if not all(column.isidentifier() for column in columns):
+            raise ValueError(f'Некорректные колонки: {columns}')
+        columns = ('user_id',) + tuple(c for c in columns if c != 'user_id')
+        select = f"SELECT {', '.join(columns)} FROM users"
+        param = '%s' if self.use_postgres else '?'
+        last_id = None
+        while True:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if last_id is None:
+                    cursor.execute(f'{select} ORDER BY user_id LIMIT {param}', (batch_size,))
+                else:
+                    cursor.execute(
+                        f'{select} WHERE user_id > {param} ORDER BY user_id LIMIT {param}',
+                        (last_id, batch_size)
+                    )
+                batch = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1]['user_id']
 
     def get_last_report_time(self, user_id: int):
         """Получить время последней жалобы"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'''
-                SELECT created_at FROM reports
-                WHERE user_id = {param}
-                ORDER BY created_at DESC LIMIT 1
-            ''', (user_id,))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(conn, cursor, 'get_last_report_time', (user_id,))
             result = cursor.fetchone()
             return result[0] if result else None
-        finally:
-            conn.close()
 
     def count_user_reports_today(self, user_id: int) -> int:
-        """Подсчитать жалобы за сегодня"""
-        today = _today_minsk().isoformat()
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'''
-                SELECT COUNT(*) FROM reports
-                WHERE user_id = {param} AND DATE(created_at) = {param}
-            ''', (user_id, today))
+        """Подсчитать жалобы за сегодня (по минскому времени)"""
+        start, end = _minsk_day_utc_bounds(_today_minsk())
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(
+                conn, cursor, 'count_user_reports_today', (user_id, start, end)
+            )
             return cursor.fetchone()[0]
-        finally:
-            conn.close()
 
     def is_user_banned(self, user_id: int) -> bool:
-        """Проверка на бан"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'SELECT warnings FROM users WHERE user_id = {param}', (user_id,))
-            result = cursor.fetchone()
-            return result and result[0] >= 3
-        finally:
-            conn.close()
+        """Проверка на бан (warnings берём из кэша get_user)"""
+        user = self.get_user(user_id)
+        return bool(user) and user['warnings'] >= 3
 
+    @_invalidates_user
     def update_challenge(self, user_id: int, challenge: str, category: str):
         """Обновить текущий челлендж пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'''
-                UPDATE users
-                SET current_challenge = {param}, current_category = {param}, challenge_date = {param}
-                WHERE user_id = {param}
-            ''', (challenge, category, _today_minsk().isoformat(), user_id))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            self._execute_prepared(
+                conn, cursor, 'update_challenge',
+                (challenge, category, _today_minsk().isoformat(), user_id)
+            )
             conn.commit()
-        finally:
-            conn.close()
 
+    @_invalidates_user
     def complete_challenge(self, user_id: int) -> Dict[str, Any]:
-        """Завершить челлендж"""
-        user = self.get_user(user_id)
-        if not user:
-            return {'success': False, 'message': 'Пользователь не найден'}
-
+        """
+        Завершить челлендж.
+        Стрик, монеты и отметка даты считаются прямо в одном UPDATE ... RETURNING,
+        без предварительного SELECT строки пользователя.
+        """
         today_dt = _today_minsk()
         today = today_dt.isoformat()
+        yesterday = (today_dt - timedelta(days=1)).isoformat()
+
+        param = '%s' if self.use_postgres else '?'
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                self._execute_prepared(
+                    conn, cursor,
+                    'complete_challenge_with_history' if self.use_postgres else 'complete_challenge',
+                    (yesterday, today, user_id)
+                )
+                row = cursor.fetchone()
 
-        # Проверка, не завершал ли уже сегодня
-        if user.get('last_completed_date') == today:
-            return {'success': False, 'message': 'Ты уже выполнил челлендж сегодня!'}
+                if row is None:
+                    # Ничего не обновилось: либо уже выполнено сегодня, либо нет пользователя
+                    cursor.execute(f'SELECT 1 FROM users WHERE user_id = {param}', (user_id,))
+                    if cursor.fetchone() is None:
+                        return {'success': False, 'message': 'Пользователь не найден'}
+                    return {'success': False, 'message': 'Ты уже выполнил челлендж сегодня!'}
 
-        # Вычисляем новый стрик
-        last_date = user.get('last_completed_date')
-        current_streak = user.get('streak', 0)
+                streak, total, total_coins, earned, current_category, current_challenge = row
 
-        if last_date is None:
-            new_streak = 1
-        else:
-            last_date_obj = date.fromisoformat(last_date)
-            diff = (today_dt - last_date_obj).days
-            if diff == 1:
-                new_streak = current_streak + 1
-            else:
-                # Проверяем заморозку стрика
-                freeze_until = user.get('streak_freeze_until')
-                if freeze_until and date.fromisoformat(freeze_until) >= today_dt:
-                    new_streak = current_streak  # заморозка активна — стрик сохраняем
-                else:
-                    new_streak = 1  # пропустил день — сброс
-
-        # Проверяем активен ли x2 бонус
-        double_until = user.get('double_coins_until')
-        if double_until and date.fromisoformat(double_until) >= today_dt:
-            coins_earned = 10
-        else:
-            coins_earned = 5
+                if not self.use_postgres:
+                    # Добавляем в историю (на Postgres это уже сделал CTE)
+                    cursor.execute('''
+                        INSERT INTO history (user_id, category, challenge)
+                        VALUES (?, ?, ?)
+                    ''', (user_id, current_category, current_challenge))
 
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-
-            current_challenge = user.get('current_challenge', '')
-            current_category = user.get('current_category', 'unknown')
+                conn.commit()
+                self._forget_leaderboard()
 
-            cursor.execute(f'''
-                UPDATE users
-                SET streak = {param},
-                    longest_streak = CASE
-                        WHEN {param} > longest_streak THEN {param}
-                        ELSE longest_streak
-                    END,
-                    total_completed = total_completed + 1,
-                    coins = coins + {param},
-                    last_completed_date = {param}
-                WHERE user_id = {param}
-            ''', (new_streak, new_streak, new_streak, coins_earned, today, user_id))
-
-            # Добавляем в историю
-            if self.use_postgres:
-                cursor.execute('''
-                    INSERT INTO history (user_id, category, challenge)
-                    VALUES (%s, %s, %s)
-                ''', (user_id, current_category, current_challenge))
-            else:
-                cursor.execute('''
-                    INSERT INTO history (user_id, category, challenge)
-                    VALUES (?, ?, ?)
-                ''', (user_id, current_category, current_challenge))
+                return {
+                    'success': True,
+                    'streak': streak,
+                    'total': total,
+                    'coins_earned': earned,
+                    'total_coins': total_coins
+                }
 
-            conn.commit()
+            except Exception as e:
+                conn.rollback()
+                return {'success': False, 'message': f'Ошибка: {str(e)}'}
 
-            # Получаем обновлённые данные
-            cursor.execute(f'SELECT * FROM users WHERE user_id = {param}', (user_id,))
-            row = cursor.fetchone()
-            if self.use_postgres:
-                columns = [desc[0] for desc in cursor.description]
-                updated_user = dict(zip(columns, row))
-            else:
-                updated_user = dict(row)
-
-            return {
-                'success': True,
-                'streak': updated_user['streak'],
-                'total': updated_user['total_completed'],
-                'coins_earned': coins_earned,
-                'total_coins': updated_user['coins']
-            }
+    def _buy_days(self, user_id: int, column: str, days: int, cost: int) -> Dict[str, Any]:
+        """
+        Списать cost монет и продлить дату column (ISO) на days дней — одним UPDATE.
+        Активная дата продлевается от неё самой, истёкшая (или пустая) — от сегодня.
+        Проверка баланса — в WHERE, так что параллельные покупки не уведут баланс в минус.
+        """
+        params = {'cost': cost, 'today': _today_minsk().isoformat(), 'days': days, 'uid': user_id}
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if self.use_postgres:
+                    cursor.execute(f'''
+                        UPDATE users
+                        SET coins = coins - %(cost)s,
+                            {column} = (
+                                GREATEST(COALESCE({column}, %(today)s), %(today)s)::date + %(days)s
+                            )::text
+                        WHERE user_id = %(uid)s AND coins >= %(cost)s
+                        RETURNING {column}
+                    ''', params)
+                else:
+                    params['days'] = f'+{days} days'
+                    cursor.execute(f'''
+                        UPDATE users
+                        SET coins = coins - :cost,
+                            {column} = date(max(COALESCE({column}, :today), :today), :days)
+                        WHERE user_id = :uid AND coins >= :cost
+                        RETURNING {column}
+                    ''', params)
+                row = cursor.fetchone()
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                return {'success': False, 'message': str(e)}
 
-        except Exception as e:
-            conn.rollback()
-            return {'success': False, 'message': f'Ошибка: {str(e)}'}
-        finally:
-            conn.close()
+        if row is None:
+            if not self.get_user(user_id):
+                return {'success': False, 'message': 'Пользователь не найден'}
+            return {'success': False, 'message': f'Недостаточно монет! Нужно {cost} 🪙'}
+        return {'success': True, 'until': row[0]}
 
+    @_invalidates_user
     def buy_streak_freeze(self, user_id: int, days: int, cost: int) -> Dict[str, Any]:
         """Купить заморозку стрика"""
-        user = self.get_user(user_id)
-        if not user:
-            return {'success': False, 'message': 'Пользователь не найден'}
-        if user['coins'] < cost:
-            return {'success': False, 'message': f'Недостаточно монет! Нужно {cost} 🪙'}
-
-        today = _today_minsk()
-        current_freeze = user.get('streak_freeze_until')
-        if current_freeze and date.fromisoformat(current_freeze) >= today:
-            base = date.fromisoformat(current_freeze)  # продлеваем существующую
-        else:
-            base = today
-        new_freeze_until = (base + timedelta(days=days)).isoformat()
-
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'''
-                UPDATE users
-                SET coins = coins - {param}, streak_freeze_until = {param}
-                WHERE user_id = {param}
-            ''', (cost, new_freeze_until, user_id))
-            conn.commit()
-            return {'success': True, 'freeze_until': new_freeze_until}
-        except Exception as e:
-            conn.rollback()
-            return {'success': False, 'message': str(e)}
-        finally:
-            conn.close()
+        result = self._buy_days(user_id, 'streak_freeze_until', days, cost)
+        if result['success']:
+            return {'success': True, 'freeze_until': result['until']}
+        return result
 
+    @_invalidates_user
     def buy_double_coins(self, user_id: int, cost: int) -> Dict[str, Any]:
         """Купить x2 монеты на 7 дней"""
-        user = self.get_user(user_id)
-        if not user:
-            return {'success': False, 'message': 'Пользователь не найден'}
-        if user['coins'] < cost:
-            return {'success': False, 'message': f'Недостаточно монет! Нужно {cost} 🪙'}
-
-        today = _today_minsk()
-        current_double = user.get('double_coins_until')
-        if current_double and date.fromisoformat(current_double) >= today:
-            base = date.fromisoformat(current_double)  # продлеваем существующий
-        else:
-            base = today
-        new_double_until = (base + timedelta(days=7)).isoformat()
-
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            cursor.execute(f'''
-                UPDATE users
-                SET coins = coins - {param}, double_coins_until = {param}
-                WHERE user_id = {param}
-            ''', (cost, new_double_until, user_id))
-            conn.commit()
-            return {'success': True, 'double_until': new_double_until}
-        except Exception as e:
-            conn.rollback()
-            return {'success': False, 'message': str(e)}
-        finally:
-            conn.close()
+        result = self._buy_days(user_id, 'double_coins_until', 7, cost)
+        if result['success']:
+            return {'success': True, 'double_until': result['until']}
+        return result
 
+    @_invalidates_user
     def coinflip_start(self, user_id: int, bet: int) -> Dict[str, Any]:
         """
-        Атомарно проверяет условия и фиксирует дату игры.
-        Монеты ещё НЕ списываются — только ставим отметку 'играл сегодня'.
-        Это одновременно и lock против параллельных сессий.
+        Атомарно проверяет условия, списывает ставку и заводит партию.
+        Отметка 'играл сегодня' — это одновременно и lock против параллельных сессий.
+        Возвращает game_id, по которому потом вызывается coinflip_finish.
         """
         today = _today_minsk().isoformat()
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            # Для Postgres используем FOR UPDATE (row-level lock)
-            if self.use_postgres:
-                cursor.execute(
-                    f'SELECT coins, lastcoinflipdate FROM users WHERE user_id = {param} FOR UPDATE',
-                    (user_id,)
-                )
-            else:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                param = '%s' if self.use_postgres else '?'
+                # Для Postgres используем FOR UPDATE (row-level lock),
+                # для SQLite сразу берём write-lock на всю транзакцию
+                if self.use_postgres:
+                    cursor.execute(
+                        f'SELECT coins, lastcoinflipdate FROM users WHERE user_id = {param} FOR UPDATE',
+                        (user_id,)
+                    )
+                else:
+                    cursor.execute('BEGIN IMMEDIATE')
+                    cursor.execute(
+                        f'SELECT coins, lastcoinflipdate FROM users WHERE user_id = {param}',
+                        (user_id,)
+                    )
+                row = cursor.fetchone()
+                if not row:
+                    return {'success': False, 'message': 'Пользователь не найден'}
+
+                coins, last_coinflip = row[0], row[1]
+
+                if last_coinflip == today:
+                    return {
+                        'success': False,
+                        'message': 'Ты уже играл в коинфлип сегодня. Попробуй снова завтра! 🎲'
+                    }
+                if coins < bet:
+                    return {
+                        'success': False,
+                        'message': f'Недостаточно монет! У тебя *{coins}* 🪙, нужно *{bet}* 🪙'
+                    }
+
                 cursor.execute(
-                    f'SELECT coins, lastcoinflipdate FROM users WHERE user_id = {param}',
-                    (user_id,)
+                    f'UPDATE users SET lastcoinflipdate = {param}, coins = coins - {param} '
+                    f'WHERE user_id = {param}',
+                    (today, bet, user_id)
                 )
-            row = cursor.fetchone()
-            if not row:
-                return {'success': False, 'message': 'Пользователь не найден'}
+                if self.use_postgres:
+                    cursor.execute(
+                        'INSERT INTO coinflip_games (user_id, bet) VALUES (%s, %s) RETURNING id',
+                        (user_id, bet)
+                    )
+                    game_id = cursor.fetchone()[0]
+                else:
+                    cursor.execute(
+                        'INSERT INTO coinflip_games (user_id, bet) VALUES (?, ?)', (user_id, bet)
+                    )
+                    game_id = cursor.lastrowid
+                conn.commit()
+                return {'success': True, 'coins': coins - bet, 'game_id': game_id}
 
-            coins, last_coinflip = row[0], row[1]
+            except Exception as e:
+                conn.rollback()
+                return {'success': False, 'message': f'Ошибка БД: {str(e)}'}
 
-            if last_coinflip == today:
-                return {
-                    'success': False,
-                    'message': 'Ты уже играл в коинфлип сегодня. Попробуй снова завтра! 🎲'
-                }
-            if coins < bet:
-                return {
-                    'success': False,
-                    'message': f'Недостаточно монет! У тебя *{coins}* 🪙, нужно *{bet}* 🪙'
-                }
+    @_invalidates_user
+    def coinflip_finish(self, user_id: int, game_id: int, won: bool) -> Dict[str, Any]:
+        """
+        Атомарно закрывает партию: при победе возвращает ставку вдвойне (net +bet),
+        при поражении списанная на старте ставка просто остаётся списанной.
+        Повторный вызов для уже закрытой партии ничего не начисляет.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                param = '%s' if self.use_postgres else '?'
+                lock = ' FOR UPDATE' if self.use_postgres else ''
+                if not self.use_postgres:
+                    cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute(
+                    f'SELECT bet FROM coinflip_games '
+                    f'WHERE id = {param} AND user_id = {param} AND resolved = 0{lock}',
+                    (game_id, user_id)
+                )
+                row = cursor.fetchone()
+                if not row:
+                    return {'success': False, 'message': 'Партия не найдена или уже завершена'}
 
-            # Фиксируем: "уже играл сегодня" — это и lock, и проверка
-            cursor.execute(
-                f'UPDATE users SET lastcoinflipdate = {param} WHERE user_id = {param}',
-                (today, user_id)
-            )
-            conn.commit()
-            return {'success': True, 'coins': coins}
+                bet = row[0]
+                cursor.execute(
+                    f'UPDATE users SET coins = coins + {param} WHERE user_id = {param}',
+                    (bet * 2 if won else 0, user_id)
+                )
+                cursor.execute(
+                    f'UPDATE coinflip_games SET resolved = 1, won = {param} WHERE id = {param}',
+                    (1 if won else 0, game_id)
+                )
+                cursor.execute(f'SELECT coins FROM users WHERE user_id = {param}', (user_id,))
+                new_coins = cursor.fetchone()[0]
+                conn.commit()
+                return {'success': True, 'new_coins': new_coins}
 
-        except Exception as e:
-            conn.rollback()
-            return {'success': False, 'message': f'Ошибка БД: {str(e)}'}
-        finally:
-            conn.close()
+            except Exception as e:
+                conn.rollback()
+                return {'success': False, 'message': f'Ошибка БД: {str(e)}'}
 
-    def coinflip_finish(self, user_id: int, bet: int, won: bool) -> Dict[str, Any]:
+    @_invalidates_user
+    def coinflip_refund(self, user_id: int, game_id: int) -> Dict[str, Any]:
         """
-        Атомарно применяет результат: +bet (победа) или -bet (поражение).
-        Вызывается только после успешного coinflip_start.
-        Монеты никогда не уходят ниже нуля.
+        Отменить партию, которая не дошла до броска кубика: вернуть ставку
+        и снять отметку 'играл сегодня', чтобы можно было сыграть заново.
+        Повторный вызов для уже закрытой партии ничего не возвращает.
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            param = '%s' if self.use_postgres else '?'
-            if self.use_postgres:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                param = '%s' if self.use_postgres else '?'
+                lock = ' FOR UPDATE' if self.use_postgres else ''
+                if not self.use_postgres:
+                    cursor.execute('BEGIN IMMEDIATE')
                 cursor.execute(
-                    f'SELECT coins FROM users WHERE user_id = {param} FOR UPDATE',
-                    (user_id,)
+                    f'SELECT bet FROM coinflip_games '
+                    f'WHERE id = {param} AND user_id = {param} AND resolved = 0{lock}',
+                    (game_id, user_id)
                 )
-            else:
+                row = cursor.fetchone()
+                if not row:
+                    return {'success': False, 'message': 'Партия не найдена или уже завершена'}
+
                 cursor.execute(
-                    f'SELECT coins FROM users WHERE user_id = {param}',
-                    (user_id,)
+                    f'UPDATE users SET coins = coins + {param}, lastcoinflipdate = CASE '
+                    f'WHEN lastcoinflipdate = {param} THEN NULL ELSE lastcoinflipdate END '
+                    f'WHERE user_id = {param}',
+                    (row[0], _today_minsk().isoformat(), user_id)
                 )
-            row = cursor.fetchone()
-            if not row:
-                return {'success': False, 'message': 'Пользователь не найден'}
-
-            coins = row[0]
-            if won:
-                # Выиграл: ставка не была списана, добавляем выигрыш (+bet)
-                # Итог: пользователь рисковал bet, получает bet*2 — net +bet
-                new_coins = coins + bet
-            else:
-                # Проиграл: списываем ставку
-                new_coins = max(0, coins - bet)
+                cursor.execute(
+                    f'UPDATE coinflip_games SET resolved = 1 WHERE id = {param}', (game_id,)
+                )
+                conn.commit()
+                return {'success': True}
 
-            cursor.execute(
-                f'UPDATE users SET coins = {param} WHERE user_id = {param}',
-                (new_coins, user_id)
-            )
-            conn.commit()
-            return {'success': True, 'new_coins': new_coins}
+            except Exception as e:
+                conn.rollback()
+                return {'success': False, 'message': f'Ошибка БД: {str(e)}'}
 
-        except Exception as e:
-            conn.rollback()
-            return {'success': False, 'message': f'Ошибка БД: {str(e)}'}
-        finally:
-            conn.close()
+    def refund_pending_coinflips(self) -> int:
+        """
+        Вернуть ставки по партиям, которые не успели завершиться (бот упал
+        во время анимации кубика). Вызывается при старте бота.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                lock = ' FOR UPDATE' if self.use_postgres else ''
+                if not self.use_postgres:
+                    cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute(
+                    f'SELECT id, user_id, bet FROM coinflip_games WHERE resolved = 0{lock}'
+                )
+                games = cursor.fetchall()
+                param = '%s' if self.use_postgres else '?'
+                today = _today_minsk().isoformat()
+                for game_id, user_id, bet in games:
+                    # Как и coinflip_refund: прерванная сегодня партия не отнимает дневную попытку
+                    cursor.execute(
+                        f'UPDATE users SET coins = coins + {param}, lastcoinflipdate = CASE '
+                        f'WHEN lastcoinflipdate = {param} THEN NULL ELSE lastcoinflipdate END '
+                        f'WHERE user_id = {param}',
+                        (bet, today, user_id)
+                    )
+                    cursor.execute(
+                        f'UPDATE coinflip_games SET resolved = 1 WHERE id = {param}', (game_id,)
+                    )
+                conn.commit()
+                self._forget_user()
+                return len(games)
+            except Exception:
+                conn.rollback()
+                raise
 
 
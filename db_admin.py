@@ -0,0 +1,38 @@
+# db_admin.py
+import sqlite3
+import sys
+
+import fix_db
+import migrations
+import test_db
+from migrations import _tune
+
+
+# Команда -> функция, принимающая уже открытое соединение
+COMMANDS = {
+    'migrate': migrations.run,
+    'fix': fix_db.run,
+    'test': test_db.run,
+}
+
+
+def main(commands):
+    """Выполняет команды по порядку на одном соединении: python db_admin.py migrate test"""
+    unknown = [name for name in commands if name not in COMMANDS]
+    if not commands or unknown:
+        print(f"Использование: python db_admin.py [{'|'.join(COMMANDS)}] ...")
+        return 1
+
+    # isolation_level=None: транзакциями управляем сами, sqlite3 не вставляет скрытых BEGIN
+    conn = sqlite3.connect('habits_bot.db', isolation_level=None)
+    _tune(conn)
+    try:
+        for name in commands:
+            COMMANDS[name](conn)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
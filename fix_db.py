@@ -1,98 +1,148 @@
 import sqlite3
-import shutil
 from datetime import datetime
 
-# Бэкап на всякий случай
-shutil.copy('habits_bot.db', f'habits_bot_backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.db')
-print("✅ Создан бэкап базы данных")
-
-conn = sqlite3.connect('habits_bot.db')
-cursor = conn.cursor()
-
-try:
-    print("\n🔄 Начинаю миграцию...")
-
-    # Создаём новую таблицу с правильными именами (БЕЗ подчеркиваний)
-    cursor.execute('''
-        CREATE TABLE users_new (
-            userid INTEGER PRIMARY KEY,
-            username TEXT,
-            firstname TEXT,
-            languagecode TEXT DEFAULT 'ru',
-            streak INTEGER DEFAULT 0,
-            longeststreak INTEGER DEFAULT 0,
-            totalcompleted INTEGER DEFAULT 0,
-            coins INTEGER DEFAULT 0,
-            lastcompleteddate TEXT,
-            purchaseditems TEXT DEFAULT '[]',
-            achievements TEXT DEFAULT '[]',
-            createdat TEXT DEFAULT CURRENT_TIMESTAMP,
-            warnings INTEGER DEFAULT 0,
-            currentchallenge TEXT,
-            currentcategory TEXT
-        )
-    ''')
-
-    # Копируем данные из старой таблицы
-    cursor.execute('''
-        INSERT INTO users_new 
-        (userid, username, streak, totalcompleted, lastcompleteddate, 
-         coins, achievements, createdat, currentchallenge, currentcategory)
-        SELECT user_id, username, streak, total_completed, last_completed_date,
-               COALESCE(coins, 0), COALESCE(achievements, '[]'), created_at, 
-               current_challenge, current_category
-        FROM users
-    ''')
-
-    # Создаём таблицу history если её нет
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            userid INTEGER,
-            category TEXT,
-            challenge TEXT,
-            completedat TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (userid) REFERENCES users(userid)
-        )
-    ''')
-
-    # Создаём таблицу reports
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            userid INTEGER,
-            username TEXT,
-            message TEXT,
-            status TEXT DEFAULT 'pending',
-            adminresponse TEXT,
-            createdat TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (userid) REFERENCES users(userid)
-        )
-    ''')
-
-    # Удаляем старую и переименовываем новую
-    cursor.execute('DROP TABLE users')
-    cursor.execute('ALTER TABLE users_new RENAME TO users')
-
-    conn.commit()
-    print("✅ Миграция успешно завершена!")
-    print("\n📊 Проверка данных:")
-
-    # Проверяем что всё ок
-    cursor.execute("SELECT COUNT(*) FROM users")
-    count = cursor.fetchone()[0]
-    print(f"   Пользователей в базе: {count}")
-
-    if count > 0:
-        cursor.execute("SELECT userid, username, totalcompleted FROM users LIMIT 3")
-        users = cursor.fetchall()
-        for u in users:
-            print(f"   ID: {u[0]}, Name: {u[1]}, Completed: {u[2]}")
-
-except Exception as e:
-    print(f"❌ ОШИБКА: {e}")
-    conn.rollback()
-    print("\n⚠️ Откат изменений... Данные не изменены")
-
-conn.close()
-print("\n✅ Готово! Теперь можно запускать бота")
+from migrations import _tune
+
+
+# Старое имя колонки -> новое (БЕЗ подчеркиваний)
+RENAMED_COLUMNS = {
+    'user_id': 'userid',
+    'first_name': 'firstname',
+    'language_code': 'languagecode',
+    'longest_streak': 'longeststreak',
+    'total_completed': 'totalcompleted',
+    'last_completed_date': 'lastcompleteddate',
+    'purchased_items': 'purchaseditems',
+    'created_at': 'createdat',
+    'current_challenge': 'currentchallenge',
+    'current_category': 'currentcategory',
+    'challenge_date': 'challengedate',
+    'streak_freeze_until': 'streakfreezeuntil',
+    'double_coins_until': 'doublecoinsuntil',
+}
+
+# Колонки, которых в старой таблице может не быть вовсе
+NEW_COLUMNS = {
+    'firstname': 'TEXT',
+    'languagecode': "TEXT DEFAULT 'ru'",
+    'longeststreak': 'INTEGER DEFAULT 0',
+    'purchaseditems': "TEXT DEFAULT '[]'",
+    'warnings': 'INTEGER DEFAULT 0',
+}
+
+
+def run(conn):
+    """
+    Бэкап и переименование колонок users в схему без подчеркиваний.
+    Итоговая таблица — целиком без подчеркиваний, как раньше давало пересоздание;
+    колонка, которой нет в RENAMED_COLUMNS, так и останется с подчеркиванием.
+    """
+    cursor = conn.cursor()
+
+    # Бэкап на всякий случай. Online backup API делает согласованный снимок с учётом WAL-файла,
+    # даже если бот сейчас пишет, и заодно прогревает кэш страниц этого соединения для миграции
+    backup = sqlite3.connect(f'habits_bot_backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.db')
+    conn.backup(backup, pages=1024)
+    backup.close()
+    print("✅ Создан бэкап базы данных")
+
+    try:
+        print("\n🔄 Начинаю миграцию...")
+
+        # Вся миграция — одна транзакция: один COMMIT вместо отдельного на каждый DDL,
+        # и rollback действительно откатывает всё
+        cursor.execute('BEGIN IMMEDIATE')
+
+        # Переименовываем колонки на месте (SQLite 3.25+) вместо копирования всей таблицы:
+        # ALTER TABLE меняет только схему, строки не переписываются
+        existing = {col[1] for col in cursor.execute("PRAGMA table_info(users)")}
+        for old, new in RENAMED_COLUMNS.items():
+            if old in existing and new not in existing:
+                cursor.execute(f'ALTER TABLE users RENAME COLUMN {old} TO {new}')
+                existing.discard(old)
+                existing.add(new)
+
+        for column, definition in NEW_COLUMNS.items():
+            if column not in existing:
+                cursor.execute(f'ALTER TABLE users ADD COLUMN {column} {definition}')
+
+        cursor.execute('''
+            UPDATE users SET coins = COALESCE(coins, 0), achievements = COALESCE(achievements, '[]')
+            WHERE coins IS NULL OR achievements IS NULL
+        ''')
+
+        # Создаём таблицу history если её нет
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                userid INTEGER,
+                category TEXT,
+                challenge TEXT,
+                completedat TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (userid) REFERENCES users(userid)
+            )
+        ''')
+
+        # Создаём таблицу reports
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reports (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                userid INTEGER,
+                username TEXT,
+                message TEXT,
+                status TEXT DEFAULT 'pending',
+                adminresponse TEXT,
+                createdat TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (userid) REFERENCES users(userid)
+            )
+        ''')
+
+        # SQLite не индексирует внешние ключи сам — без индексов выборки по пользователю идут полным сканом.
+        # Имена и определения — как у бота (database.py), чтобы не завести дубли его индексов.
+        # history/reports могли быть созданы ботом раньше, тогда колонки ещё с подчеркиваниями
+        history_columns = {col[1] for col in cursor.execute("PRAGMA table_info(history)")}
+        reports_columns = {col[1] for col in cursor.execute("PRAGMA table_info(reports)")}
+        history_user = 'userid' if 'userid' in history_columns else 'user_id'
+        reports_user = 'userid' if 'userid' in reports_columns else 'user_id'
+        reports_created = 'createdat' if 'createdat' in reports_columns else 'created_at'
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_history_user_category
+            ON history ({history_user}, category)
+        ''')
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_reports_user
+            ON reports ({reports_user}, {reports_created} DESC)
+        ''')
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_reports_pending
+            ON reports ({reports_created} DESC) WHERE status = 'pending'
+        ''')
+
+        cursor.execute('COMMIT')
+        print("✅ Миграция успешно завершена!")
+        print("\n📊 Проверка данных:")
+
+        # Проверяем что всё ок
+        cursor.execute("SELECT COUNT(*) FROM users")
+        count = cursor.fetchone()[0]
+        print(f"   Пользователей в базе: {count}")
+
+        if count > 0:
+            for u in cursor.execute("SELECT userid, username, totalcompleted FROM users LIMIT 3"):
+                print(f"   ID: {u[0]}, Name: {u[1]}, Completed: {u[2]}")
+
+    except Exception as e:
+        print(f"❌ ОШИБКА: {e}")
+        conn.rollback()
+        print("\n⚠️ Откат изменений... Данные не изменены")
+
+    cursor.execute('PRAGMA optimize')
+
+
+if __name__ == '__main__':
+    # isolation_level=None: транзакциями управляем сами, sqlite3 не вставляет скрытых BEGIN
+    conn = sqlite3.connect('habits_bot.db', isolation_level=None)
+    _tune(conn)
+    run(conn)
+    conn.close()
+    print("\n✅ Готово! Теперь можно запускать бота")
@@ -1,39 +1,15 @@
 # migrate_admin.py
-import sqlite3
+from migrations import apply
 
 
 def migrate():
-    """Миграция для админ-панели"""
-    conn = sqlite3.connect('habits_bot.db')
-    cursor = conn.cursor()
-
-    # Добавляем колонку warnings если её нет
+    """Миграция для админ-панели: таблица reports с индексами и колонка warnings — миграции 3–5 в migrations.py"""
     try:
-        cursor.execute('ALTER TABLE users ADD COLUMN warnings INTEGER DEFAULT 0')
-        print("✅ Добавлена колонка warnings")
+        apply()
     except Exception as e:
-        print(f"⚠️ Колонка warnings: {e}")
-
-    # Создаём таблицу reports
-    try:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS reports (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                username TEXT,
-                message TEXT,
-                status TEXT DEFAULT 'pending',
-                admin_response TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        print("✅ Создана таблица reports")
-    except Exception as e:
-        print(f"⚠️ Таблица reports: {e}")
-
-    conn.commit()
-    conn.close()
+        # Не мешаем запуску бота (Procfile: migrate_admin.py && bot.py) — схему он досоздаст сам
+        print(f"⚠️ Миграция не применена: {e}")
+        return
     print("✅ Миграция завершена!")
 
 
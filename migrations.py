@@ -0,0 +1,138 @@
+# migrations.py
+import sqlite3
+from datetime import datetime
+
+
+def _tune(conn):
+    """PRAGMA как у бота: в WAL бот читает, пока скрипт пишет; busy_timeout — ждём блокировку, а не падаем"""
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+
+
+def _user_columns(cursor):
+    """Колонки users; пустое множество — таблицы ещё нет, бот создаст её сразу с полной схемой"""
+    cursor.execute("PRAGMA table_info(users)")
+    return {col[1] for col in cursor.fetchall()}
+
+
+def _add_user_column(cursor, column, definition):
+    """ALTER TABLE ADD COLUMN, только если колонки ещё нет (база могла быть создана ботом)"""
+    columns = _user_columns(cursor)
+    if columns and column not in columns:
+        cursor.execute(f'ALTER TABLE users ADD COLUMN {column} {definition}')
+
+
+def _add_coins(cursor):
+    _add_user_column(cursor, 'coins', 'INTEGER DEFAULT 0')
+
+
+def _add_achievements(cursor):
+    _add_user_column(cursor, 'achievements', "TEXT DEFAULT '[]'")
+    if not _user_columns(cursor):
+        return
+    # Обновляем все NULL значения на дефолтные — одним проходом по таблице
+    cursor.execute('''
+        UPDATE users SET coins = COALESCE(coins, 0), achievements = COALESCE(achievements, '[]')
+        WHERE coins IS NULL OR achievements IS NULL
+    ''')
+
+
+def _add_reports(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            username TEXT,
+            message TEXT,
+            status TEXT DEFAULT 'pending',
+            admin_response TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+
+def _add_warnings(cursor):
+    _add_user_column(cursor, 'warnings', 'INTEGER DEFAULT 0')
+
+
+def _add_reports_indexes(cursor):
+    # Те же индексы, что создаёт бот (database.py): отчёты пользователя и очередь pending для админки
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_reports_user
+        ON reports (user_id, created_at DESC)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_reports_pending
+        ON reports (created_at DESC) WHERE status = 'pending'
+    ''')
+
+
+# Версия -> (описание, функция миграции). Новые миграции — только в конец списка
+MIGRATIONS = [
+    (1, 'колонка coins', _add_coins),
+    (2, 'колонка achievements', _add_achievements),
+    (3, 'таблица reports', _add_reports),
+    (4, 'колонка warnings', _add_warnings),
+    (5, 'индексы reports', _add_reports_indexes),
+]
+
+
+def run(conn):
+    """Применяет ещё не применённые миграции одной транзакцией; возвращает их количество"""
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            applied_at TEXT
+        )
+    ''')
+
+    applied = 0
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        # Читаем версии уже под блокировкой записи — параллельный запуск не применит миграцию дважды
+        cursor.execute('SELECT version FROM schema_migrations')
+        done = {row[0] for row in cursor.fetchall()}
+
+        for version, description, migration in MIGRATIONS:
+            if version in done:
+                continue
+            migration(cursor)
+            cursor.execute(
+                'INSERT INTO schema_migrations (version, applied_at) VALUES (?, ?)',
+                (version, datetime.now().isoformat())
+            )
+            applied += 1
+            print(f"✅ Миграция {version}: {description}")
+
+        cursor.execute('COMMIT')
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ ОШИБКА: {e}")
+        print("⚠️ Откат изменений... Данные не изменены")
+        raise
+
+    if applied:
+        # Схема поменялась — даём SQLite обновить статистику планировщика
+        cursor.execute('PRAGMA optimize')
+    else:
+        print("✅ База уже актуальна")
+    return applied
+
+
+def apply(db_path='habits_bot.db'):
+    """Открывает базу и применяет миграции (см. run)"""
+    # isolation_level=None: транзакциями управляем сами, sqlite3 не вставляет скрытых BEGIN
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    _tune(conn)
+    try:
+        return run(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    apply()
@@ -1,46 +1,59 @@
 import sqlite3
 
-conn = sqlite3.connect('habits_bot.db')
-cursor = conn.cursor()
-
-print("=" * 60)
-print("ПРОВЕРКА БАЗЫ ДАННЫХ")
-print("=" * 60)
-
-# Проверяем структуру users
-try:
-    cursor.execute("PRAGMA table_info(users)")
-    cols = cursor.fetchall()
-    print("\n📋 Колонки в таблице users:")
-    for col in cols:
-        print(f"  - {col[1]} ({col[2]})")
-except Exception as e:
-    print(f"ОШИБКА таблицы users: {e}")
-
-# Проверяем данные
-try:
-    cursor.execute("SELECT COUNT(*) FROM users")
-    count = cursor.fetchone()[0]
-    print(f"\n👥 Пользователей в базе: {count}")
-
-    if count > 0:
-        cursor.execute("SELECT userid, username, totalcompleted, streak FROM users LIMIT 3")
-        users = cursor.fetchall()
-        print("\n📊 Примеры данных:")
-        for u in users:
-            print(f"  ID: {u[0]}, Name: {u[1]}, Total: {u[2]}, Streak: {u[3]}")
-except Exception as e:
-    print(f"ОШИБКА чтения данных: {e}")
-
-# Проверяем структуру reports
-try:
-    cursor.execute("PRAGMA table_info(reports)")
-    cols = cursor.fetchall()
-    print("\n📋 Колонки в таблице reports:")
-    for col in cols:
-        print(f"  - {col[1]} ({col[2]})")
-except Exception as e:
-    print(f"ОШИБКА таблицы reports: {e}")
-
-conn.close()
-print("\n" + "=" * 60)
\ No newline at end of file
+from migrations import _tune
+
+
+# Список колонок таблицы одной строкой — форматирование делает сам SQLite
+COLUMNS_SQL = """
+    SELECT GROUP_CONCAT(line, CHAR(10)) FROM (
+        SELECT '  - ' || name || ' (' || type || ')' AS line
+        FROM pragma_table_info(?) ORDER BY cid
+    )
+"""
+
+
+def run(conn):
+    """Печатает структуру таблиц и несколько строк users"""
+    cursor = conn.cursor()
+
+    print("=" * 60)
+    print("ПРОВЕРКА БАЗЫ ДАННЫХ")
+    print("=" * 60)
+
+    # Проверяем структуру users
+    try:
+        cursor.execute(COLUMNS_SQL, ('users',))
+        print("\n📋 Колонки в таблице users:")
+        print(cursor.fetchone()[0] or '')
+    except Exception as e:
+        print(f"ОШИБКА таблицы users: {e}")
+
+    # Проверяем данные
+    try:
+        cursor.execute("SELECT COUNT(*) FROM users")
+        count = cursor.fetchone()[0]
+        print(f"\n👥 Пользователей в базе: {count}")
+
+        if count > 0:
+            print("\n📊 Примеры данных:")
+            for u in cursor.execute("SELECT userid, username, totalcompleted, streak FROM users LIMIT 3"):
+                print(f"  ID: {u[0]}, Name: {u[1]}, Total: {u[2]}, Streak: {u[3]}")
+    except Exception as e:
+        print(f"ОШИБКА чтения данных: {e}")
+
+    # Проверяем структуру reports
+    try:
+        cursor.execute(COLUMNS_SQL, ('reports',))
+        print("\n📋 Колонки в таблице reports:")
+        print(cursor.fetchone()[0] or '')
+    except Exception as e:
+        print(f"ОШИБКА таблицы reports: {e}")
+
+    print("\n" + "=" * 60)
+
+
+if __name__ == '__main__':
+    conn = sqlite3.connect('habits_bot.db', isolation_level=None)
+    _tune(conn)
+    run(conn)
+    conn.close()